@@ -3,35 +3,99 @@ Configuration helpers. The config mechanism is intended to work in concert with
 per module. This config.ini can define variables or use string interpolation to fill in fanlens level environment
 variables following the pattern FL_*
 """
-from typing import Dict, Optional, List
-from collections import ItemsView
-import inspect
+from typing import Any, Callable, Dict, Optional, List, Tuple
+from collections.abc import ItemsView
+import importlib.util
+import logging
 import os
-from configparser import ConfigParser
-from functools import lru_cache
+import re
+import signal
+import sys
+import threading
+from configparser import ConfigParser, Error
+from functools import lru_cache, partial
 
-from pkg_resources import resource_string
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+_DURATION_PART = re.compile(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*(ms|s|m|h|d|w)?\s*')
+
+
+def parse_duration(value: str) -> float:
+    """:return: the seconds of a duration like `30`, `1.5s`, `250ms` or `1h 30m`, a plain number counts as seconds"""
+    seconds, position = 0.0, 0
+    for match in _DURATION_PART.finditer(value):
+        if match.start() != position:
+            break
+        seconds += float(match.group(1)) * _DURATION_UNITS[match.group(2) or 's']
+        position = match.end()
+    if not position or position != len(value):
+        raise ValueError('invalid duration: %s' % value)
+    return seconds
 
 
 class StrictEnvDefaultConfigParser(ConfigParser):  # pylint: disable=too-many-ancestors
     """
     A stricter version of the default config parser that automatically pulls in environment variables starting with
     FL_ on access. The default behaviour leads to spurious elements.
+
+    The environment is scanned once and all options are resolved into a snapshot on first access, `reload` (or
+    `reload_if_changed`) rereads the config file and the environment and notifies the subscribers. Next to the usual
+    `getint`, `getfloat` and `getboolean` there's `getduration`, see `parse_duration`.
     """
 
     def __init__(self, defaults: Optional[Dict] = None) -> None:
-        super().__init__(defaults=defaults)
+        super().__init__(defaults=defaults, converters=dict(duration=parse_duration))
+        self._lock = threading.RLock()
+        self._initial_defaults = dict(defaults or {})
+        self._environment = None  # type: Optional[Dict[str, str]]
+        self._snapshot = None  # type: Optional[Dict[str, Dict[str, str]]]
+        self._subscribers = []  # type: List[Callable[[StrictEnvDefaultConfigParser], Any]]
+        self.source = None  # type: Optional[Callable[[], Tuple[str, Optional[str]]]]
+        self.path = None  # type: Optional[str]
+        self.mtime = None  # type: Optional[float]
+
+    @property
+    def environment(self) -> Dict[str, str]:
+        """:return: the FL_* environment variables, scanned once"""
+        environment = self._environment
+        if environment is None:
+            environment = self._environment = dict((k, v) for k, v in os.environ.items() if k.startswith('FL_'))
+        return environment
+
+    def snapshot(self) -> Dict[str, Dict[str, str]]:
+        """:return: all resolved options per section, options that fail to resolve are left out"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = {}
+                for section in self.sections() + [self.default_section]:
+                    resolved = snapshot[section] = {}
+                    options = self.options(section) if section != self.default_section else list(self.defaults())
+                    for option in options:
+                        try:
+                            resolved[option] = ConfigParser.get(self, section, option, vars=self.environment)
+                        except Error:
+                            pass
+                self._snapshot = snapshot
+        return snapshot
 
     def get(self, section: str, option: str, *, raw: bool = False, vars: Optional[Dict] = None,  # type: ignore
             fallback: Optional[str] = None) -> str:
         # pylint: disable=redefined-builtin
         # honor superclass signature (vars)
-        _vars = vars or dict((k, v) for k, v in os.environ.items() if k.startswith('FL_'))
+        if not raw and vars is None:
+            value = self.snapshot().get(section, {}).get(self.optionxform(option))
+            if value is not None:
+                return value
+        _vars = vars or self.environment
         if fallback:
             return ConfigParser.get(self, section, option, raw=raw, vars=_vars, fallback=fallback)
 
         return ConfigParser.get(self, section, option, raw=raw, vars=_vars)
 
+    def set(self, section: str, option: str, value: Optional[str] = None) -> None:
+        super().set(section, option, value)
+        self._snapshot = None
+
     def items(self, section: Optional[str] = None, raw: bool = False,  # type: ignore
               vars: Optional[Dict] = None) -> ItemsView:
         # pylint: disable=redefined-builtin
@@ -46,16 +110,97 @@ class StrictEnvDefaultConfigParser(ConfigParser):  # pylint: disable=too-many-an
                     for iter_section in sections
                     for iter_option in self.options(iter_section)).items()
 
+    def subscribe(self, callback: Callable[['StrictEnvDefaultConfigParser'], Any]) -> None:
+        """:param callback: called with the parser after every reload, e.g. to resize pools or update timeouts"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[['StrictEnvDefaultConfigParser'], Any]) -> None:
+        """:param callback: a previously subscribed callback"""
+        self._subscribers.remove(callback)
+
+    def load(self, source: Callable[[], Tuple[str, Optional[str]]]) -> None:
+        """
+        :param source: returns the config file content and its path, if it's a file, used again by `reload`
+        :raises configparser.Error: if the content doesn't parse, the parser is left unchanged
+        """
+        content, path = source()
+        # parse into a throwaway parser first, a malformed file must not leave this one half rewritten
+        parsed = ConfigParser(defaults=self._initial_defaults)
+        parsed.optionxform = self.optionxform  # type: ignore
+        parsed.read_string(content)
+        with self._lock:
+            for section in self.sections():
+                self.remove_section(section)
+            self.defaults().clear()
+            self.read_dict({'DEFAULT': self._initial_defaults})
+            self.read_string(content)
+            self.source, self.path = source, path
+            self.mtime = _mtime(path)
+            self._environment = None
+            self._snapshot = None
+
+    def reload(self) -> None:
+        """reread the config file and the environment, then notify the subscribers"""
+        if self.source is not None:
+            self.load(self.source)
+        else:
+            with self._lock:
+                self._environment = None
+                self._snapshot = None
+        for callback in list(self._subscribers):
+            try:
+                callback(self)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('config subscriber %r failed', callback)
+
+    def reload_if_changed(self) -> bool:
+        """:return: whether the config file was modified and hence reloaded"""
+        mtime = _mtime(self.path)
+        if self.path is None or mtime == self.mtime:
+            return False
+        self.mtime = mtime  # a modification that fails to load is tried once, not on every check
+        self.reload()
+        return True
+
+
+def _mtime(path: Optional[str]) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+_LOADED = []  # type: List[StrictEnvDefaultConfigParser]
+
+
+def _read_config(module_name: str, config_file_name: str) -> Tuple[str, Optional[str]]:
+    """
+    :return: the content of the config file next to the module and its path on disk, if any. resolved like
+             `pkg_resources.resource_string` but without importing `pkg_resources`, which is slow to import
+    """
+    module = sys.modules.get(module_name)
+    origin, loader = getattr(module, '__file__', None), getattr(module, '__loader__', None)
+    if module is None:
+        spec = importlib.util.find_spec(module_name)
+        origin, loader = (spec.origin, spec.loader) if spec is not None else (None, None)
+    # like `pkg_resources` modules without a file, e.g. `python -c`, are resolved relative to the working directory
+    path = os.path.normpath(os.path.join(os.path.dirname(origin or ''), config_file_name))
+    if hasattr(loader, 'get_data'):  # works for zipped packages as well
+        data = loader.get_data(path)  # type: ignore
+    else:
+        with open(path, 'rb') as config_file:
+            data = config_file.read()
+    return str(data, 'utf-8'), path if os.path.isfile(path) else None
+
 
 @lru_cache()
 def _get_config(module_name: str, config_file_name: str, max_depth: int = 0) -> StrictEnvDefaultConfigParser:
     parser = StrictEnvDefaultConfigParser()
-    config_string = ''
     read_err = None
     found = False
     while max_depth >= 0 and not found:
         try:
-            config_string = str(resource_string(module_name, config_file_name), 'utf-8')
+            parser.load(partial(_read_config, module_name, config_file_name))
             found = True
         except FileNotFoundError as err:
             read_err = err
@@ -63,7 +208,7 @@ def _get_config(module_name: str, config_file_name: str, max_depth: int = 0) ->
             max_depth -= 1
     if not found:
         raise read_err or RuntimeError('Could not load config file')
-    parser.read_string(config_string)
+    _LOADED.append(parser)
     return parser
 
 
@@ -77,7 +222,44 @@ def get_config(module_name: Optional[str] = None,
     :return: the parsed config file using os.environ as defaults
     """
     if not module_name:
-        caller_frame = inspect.stack()[1]
-        caller_module = inspect.getmodule(caller_frame[0])
-        module_name = caller_module.__name__
+        # a single frame lookup, `inspect.stack` would read the source of every frame
+        module_name = sys._getframe(1).f_globals['__name__']  # pylint: disable=protected-access
     return _get_config(module_name, config_file_name, max_depth)
+
+
+def reload_configs(only_changed: bool = False) -> None:
+    """
+    reload all loaded configs, a config failing to load is logged and keeps its previous values
+    :param only_changed: only reload configs whose file was modified since it was loaded
+    """
+    for parser in list(_LOADED):
+        try:
+            if only_changed:
+                parser.reload_if_changed()
+            else:
+                parser.reload()
+        except (Error, OSError, UnicodeDecodeError):
+            logging.exception('reloading config %s failed, keeping the previous one', parser.path)
+
+
+def install_reload_handler(signum: int = signal.SIGHUP) -> None:
+    """reload all loaded configs when the process receives `signum`, has to be called from the main thread"""
+    signal.signal(signum, lambda *_: reload_configs())
+
+
+def watch_configs(interval: float = 5.0) -> threading.Event:
+    """
+    reload configs whose file was modified, checked every `interval` seconds in a daemon thread
+    :return: an event stopping the watch when set
+    """
+    stopped = threading.Event()
+
+    def _watch() -> None:
+        while not stopped.wait(interval):
+            try:
+                reload_configs(only_changed=True)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('watching the configs failed')
+
+    threading.Thread(target=_watch, name='config-watch', daemon=True).start()
+    return stopped
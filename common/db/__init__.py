@@ -1,34 +1,103 @@
 """the db module is responsible for managing the database connections it's based on sqlalchemy"""
 
 import logging
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
-from multiprocessing.util import register_after_fork
-from typing import Set, Optional, Generator, Any
+from functools import lru_cache, partial
+from itertools import islice
+from operator import attrgetter
+from typing import (Set, Optional, Generator, Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Sequence,
+                    Tuple, Union)
 
 import sqlalchemy
+import sqlalchemy.exc
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.engine import Engine, ResultProxy
+from sqlalchemy.engine import Connection, Engine, ResultProxy
+from sqlalchemy.schema import Table
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, Query
+from sqlalchemy.orm import class_mapper, sessionmaker, Session, Query
 from sqlalchemy.sql.compiler import SQLCompiler
-from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.expression import Executable, Insert, Select, bindparam
+from sqlalchemy.util import LRUCache
 
 from ..config import get_config
 
 ON_CONFLICT_DO_NOTHING = 'ON CONFLICT DO NOTHING'
 ON_CONFLICT_DO_UPDATE = 'ON CONFLICT (%(column)s) DO UPDATE SET %(updates)s'
+ON_CONFLICT_TARGET_DO_NOTHING = 'ON CONFLICT (%(column)s) DO NOTHING'
+
+STATEMENT_CACHE_SIZE = 256
+BULK_STATEMENT_CACHE_SIZE = 16
+
+DEFAULT_ENGINE = 'DB'
+REPLICA_SUFFIX = '_REPLICA'
+ROUND_ROBIN = 'round_robin'
+LEAST_CONNECTIONS = 'least_connections'
+
+_PREPARER = postgresql.dialect().identifier_preparer
+
+UpsertResult = namedtuple('UpsertResult', ['rowcount', 'rows'])
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+BulkFailure = namedtuple('BulkFailure', ['item', 'error'])
 
 
 def _compiled_str(query: Query) -> str:
     return str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
 
 
+class ModelExtractor:
+    """
+    Precomputed column access for a declarative class. Turns instances into parameter dicts or tuples with a single
+    `attrgetter` call instead of looking up every column by name.
+    """
+
+    def __init__(self, model_class: declarative_base) -> None:
+        self._mapper = class_mapper(model_class)
+        self.columns = tuple(column.name for column in model_class.__table__.columns)
+        self._getters = {}  # type: Dict[Tuple[str, ...], Callable[[Any], Tuple]]
+        self._all = self.tuple_getter(self.columns)
+
+    def tuple_getter(self, columns: Sequence[str]) -> Callable[[Any], Tuple]:
+        """:return: a callable returning the values of `columns` (by column name) of an instance as tuple"""
+        columns = tuple(columns)
+        getter = self._getters.get(columns)
+        if getter is None:
+            table = self._mapper.local_table
+            keys = [self._mapper.get_property_by_column(table.c[name]).key for name in columns]
+            single = attrgetter(*keys)
+            getter = (lambda instance: (single(instance),)) if len(keys) == 1 else single
+            self._getters[columns] = getter
+        return getter
+
+    def to_dict(self, instance: declarative_base) -> Dict[str, Any]:
+        """:return: dict version of the instance, `None` values are skipped"""
+        return dict((name, value) for name, value in zip(self.columns, self._all(instance)) if value is not None)
+
+    def to_dicts(self, instances: Iterable[declarative_base]) -> List[Dict[str, Any]]:
+        """:return: dict versions of the instances, `None` values are skipped"""
+        columns, getter = self.columns, self._all
+        return [dict((name, value) for name, value in zip(columns, getter(instance)) if value is not None)
+                for instance in instances]
+
+    def to_tuples(self, instances: Iterable[declarative_base],
+                  columns: Optional[Sequence[str]] = None) -> List[Tuple]:
+        """:return: the values of `columns`, defaulting to all columns, of the instances as tuples"""
+        getter = self.tuple_getter(columns) if columns is not None else self._all
+        return [getter(instance) for instance in instances]
+
+
+@lru_cache(maxsize=None)
+def model_extractor(model_class: declarative_base) -> ModelExtractor:
+    """:return: the cached `ModelExtractor` for `model_class`"""
+    return ModelExtractor(model_class)
+
+
 def _get_model_dict(model: declarative_base) -> dict:
     """:return: dict version of the model"""
-    return dict((column.name, getattr(model, column.name))
-                for column in model.__table__.columns
-                if getattr(model, column.name) is not None)
+    return model_extractor(type(model)).to_dict(model)
 
 
 @compiles(Insert)
@@ -45,24 +114,177 @@ def _append_string(insert: Insert, compiler: SQLCompiler, **kwargs: Any) -> str:
 Insert.argument_for("postgresql", "append_string", None)
 
 
-def insert_or_update(session: Session,
-                     entry: declarative_base,
-                     column: str,
-                     update_fields: Optional[Set[str]] = None,
-                     exclude_fields: Optional[Set[str]] = None,
-                     flush: bool = False) -> ResultProxy:
-    # pylint: disable=too-many-arguments
-    """postgresql specific insert or update logic"""
+class _StatementCache:
+    """
+    Bounded LRU cache of upsert statements. The statements are reused as keys of the sqlalchemy `compiled_cache`, this
+    way neither the `ON CONFLICT` clause nor the compiled SQL is rebuilt for repeated calls.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._statements = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self.compiled = LRUCache(maxsize)
+
+    def get(self, key: Tuple, factory: Callable[[], Insert]) -> Insert:
+        """:return: the cached statement for `key`, created via `factory` on a miss"""
+        with self._lock:
+            statement = self._statements.get(key)
+            if statement is not None:
+                self._hits += 1
+                self._statements.move_to_end(key)
+                return statement
+            self._misses += 1
+        statement = factory()
+        with self._lock:
+            self._statements[key] = statement
+            while len(self._statements) > self._maxsize:
+                self._statements.popitem(last=False)
+        return statement
+
+    def info(self) -> CacheInfo:
+        """:return: hit/miss statistics, see `functools.lru_cache`"""
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._statements))
+
+    def clear(self) -> None:
+        """drop all cached statements and reset the statistics"""
+        with self._lock:
+            self._statements.clear()
+            self.compiled.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+_STATEMENT_CACHE = _StatementCache(STATEMENT_CACHE_SIZE)
+# multi-row statements carry thousands of bind parameters, they are kept apart to not evict the single row ones
+_BULK_STATEMENT_CACHE = _StatementCache(BULK_STATEMENT_CACHE_SIZE)
+
+
+def statement_cache_info() -> CacheInfo:
+    """:return: statistics of the upsert statement cache"""
+    return _STATEMENT_CACHE.info()
+
+
+def statement_cache_clear() -> None:
+    """clear the upsert statement cache"""
+    _STATEMENT_CACHE.clear()
+    _BULK_STATEMENT_CACHE.clear()
+
+
+def _execute_cached(session: Session,
+                    statement: Insert,
+                    params: Dict[str, Any],
+                    cache: Optional[_StatementCache] = _STATEMENT_CACHE) -> ResultProxy:
+    """execute `statement` reusing its compiled form from `cache`, if any"""
+    connection = session.connection(clause=statement)
+    if cache is not None:
+        connection = connection.execution_options(compiled_cache=cache.compiled)
+    return connection.execute(statement, params)
+
+
+def _conflict_columns(column: Union[str, Iterable[str]]) -> Tuple[str, ...]:
+    """:return: the conflict target as tuple of column names, accepts `'a, b'` as well as `('a', 'b')`"""
+    if isinstance(column, str):
+        return tuple(name.strip() for name in column.split(','))
+    return tuple(column)
+
+
+def _returning_columns(table: Table, returning: Optional[Union[str, Sequence[Any]]]) -> Tuple[Any, ...]:
+    """:return: the columns of `table` referenced by `returning`, either by name or as columns"""
+    if returning is None:
+        return ()
+    if isinstance(returning, str):
+        returning = _conflict_columns(returning)
+    return tuple(table.c[column] if isinstance(column, str) else column for column in returning)
+
+
+def _excluded_updates(update_fields: Iterable[str]) -> str:
+    """:return: the `SET` part of an upsert taking the new values from the proposed (`EXCLUDED`) row"""
+    return ', '.join('{0} = EXCLUDED.{0}'.format(_PREPARER.quote(key)) for key in sorted(update_fields))
+
+
+def _on_conflict_update(table: Table, column: str, update_fields: Iterable[str], only_changed: bool = False) -> str:
+    """
+    :param only_changed: add an `IS DISTINCT FROM` guard, conflicting rows whose values wouldn't change are skipped
+    :return: the `ON CONFLICT ... DO UPDATE` clause
+    """
+    update_fields = sorted(update_fields)
+    clause = ON_CONFLICT_DO_UPDATE % dict(column=column, updates=_excluded_updates(update_fields))
+    if only_changed and update_fields:
+        current = ', '.join('%s.%s' % (_PREPARER.quote(table.name), _PREPARER.quote(key)) for key in update_fields)
+        proposed = ', '.join('EXCLUDED.%s' % _PREPARER.quote(key) for key in update_fields)
+        clause += ' WHERE ROW(%s) IS DISTINCT FROM ROW(%s)' % (current, proposed)
+    return clause
+
+
+def _upsert_statement(table: Table,
+                      append_string: str,
+                      returning: Tuple[Any, ...] = (),
+                      columns: Optional[Tuple[str, ...]] = None,
+                      rows: int = 0) -> Insert:
+    """
+    :param columns: the columns of a multi-row insert
+    :param rows: number of rows of a multi-row insert, the bind parameters are named `<column>_<row>`
+    :return: a new insert statement with the `ON CONFLICT` clause appended
+    """
+    insert = table.insert(postgresql_append_string=append_string)
+    if rows:
+        insert = insert.values([dict((name, bindparam('%s_%d' % (name, row), type_=table.c[name].type))
+                                     for name in columns or ())
+                                for row in range(rows)])
+    if returning:
+        insert = insert.returning(*returning)
+    return insert
+
+
+def _insert_or_update_statement(entry: declarative_base,
+                                column: str,
+                                update_fields: Optional[Set[str]] = None,
+                                exclude_fields: Optional[Set[str]] = None,
+                                only_changed: bool = False) -> Tuple[Insert, Dict[str, Any]]:
+    """:return: the cached insert or update statement for `entry` and its parameters"""
     if exclude_fields is None:
         exclude_fields = set()
 
     model_dict = _get_model_dict(entry)
     if update_fields is None:
         update_fields = set(model_dict.keys())
-    update_fields = set(update_fields).difference(set(exclude_fields))
-    update_string = ', '.join(['{0} = %({0})s'.format(key) for key in update_fields])
-    result = session.execute(entry.__table__.insert(
-        postgresql_append_string=ON_CONFLICT_DO_UPDATE % dict(column=column, updates=update_string)), model_dict)
+    update_fields = frozenset(update_fields).difference(exclude_fields)
+    table = entry.__table__
+    statement = _STATEMENT_CACHE.get(
+        (table, ON_CONFLICT_DO_UPDATE, column, update_fields, only_changed),
+        lambda: _upsert_statement(table, _on_conflict_update(table, column, update_fields, only_changed)))
+    return statement, model_dict
+
+
+def _insert_or_ignore_statement(entry: declarative_base,
+                                returning: Optional[str] = None) -> Tuple[Insert, Dict[str, Any]]:
+    """:return: the cached insert or ignore statement for `entry` and its parameters"""
+    table = entry.__table__
+    returning_columns = _returning_columns(table, returning)
+    statement = _STATEMENT_CACHE.get(
+        (table, ON_CONFLICT_DO_NOTHING, returning_columns),
+        lambda: _upsert_statement(table, ON_CONFLICT_DO_NOTHING, returning_columns))
+    return statement, _get_model_dict(entry)
+
+
+def insert_or_update(session: Session,
+                     entry: declarative_base,
+                     column: str,
+                     update_fields: Optional[Set[str]] = None,
+                     exclude_fields: Optional[Set[str]] = None,
+                     flush: bool = False,
+                     only_changed: bool = False) -> ResultProxy:
+    # pylint: disable=too-many-arguments
+    """
+    postgresql specific insert or update logic
+    :param only_changed: skip the update if no value changes, `ResultProxy.rowcount` is 0 for skipped rows
+    """
+    result = _execute_cached(session, *_insert_or_update_statement(entry, column, update_fields, exclude_fields,
+                                                                   only_changed))
     if flush:
         session.flush()
     return result
@@ -73,16 +295,162 @@ def insert_or_ignore(session: Session,
                      flush: bool = False,
                      returning: Optional[str] = None) -> ResultProxy:
     """postgresql specific insert or ignore logic"""
-    result = session.execute(
-        entry.__table__.insert(postgresql_append_string=ON_CONFLICT_DO_NOTHING, returning=returning),
-        _get_model_dict(entry))
+    result = _execute_cached(session, *_insert_or_ignore_statement(entry, returning))
     if flush:
         session.flush()
     return result
 
 
+def _chunked(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """:return: lists of at most `size` elements drawn from `iterable`"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def _insert_many(session: Session,
+                 model: declarative_base,
+                 entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                 append_string: Callable[[FrozenSet[str]], str],
+                 key_columns: Tuple[str, ...],
+                 returning: Optional[Sequence[str]],
+                 chunk_size: int,
+                 deduplicate: bool = False) -> UpsertResult:
+    # pylint: disable=too-many-arguments,too-many-locals
+    """
+    shared implementation of the bulk upserts, executes one multi-row insert per chunk and distinct set of columns
+    :param append_string: callable of the form (columns: FrozenSet[str]) -> str creating the `ON CONFLICT` clause
+    :param deduplicate: only send the last entry per conflict key of a chunk, `DO UPDATE` can't touch a row twice.
+                        keys containing `None` are left alone, postgres never considers them conflicting
+    """
+    assert chunk_size > 0, "chunk_size must be at least 1"
+    table = model.__table__
+    to_dict = model_extractor(model).to_dict
+    returning_columns = ()  # type: Tuple[Any, ...]
+    if returning is not None:
+        if not key_columns:
+            raise ValueError('returning rows requires a conflict target to map them back to the input')
+        returning_columns = _returning_columns(
+            table, list(returning) + [name for name in key_columns if name not in returning])
+    rowcount = 0
+    rows = [] if returning is not None else None  # type: Optional[List[Any]]
+    for chunk in _chunked(entries, chunk_size):
+        chunk_dicts = [entry if isinstance(entry, dict) else to_dict(entry) for entry in chunk]
+        # deduplicate before grouping by column set, the last entry of a key wins whatever columns it provides
+        unique = {}  # type: Dict[Any, Dict[str, Any]]
+        for position, entry_dict in enumerate(chunk_dicts):
+            key = position  # type: Any
+            if deduplicate:
+                conflict_key = tuple(entry_dict.get(name) for name in key_columns)
+                if None not in conflict_key:  # NULL never conflicts, such entries are all inserted
+                    key = conflict_key
+            unique[key] = entry_dict
+        groups = {}  # type: Dict[FrozenSet[str], List[Dict[str, Any]]]
+        for entry_dict in unique.values():
+            groups.setdefault(frozenset(entry_dict.keys()), []).append(entry_dict)
+        returned = {}  # type: Dict[Tuple, Any]
+        for columns, group in groups.items():
+            ordered_columns = tuple(sorted(columns))
+            conflict = append_string(columns)
+            # only full chunks repeat reliably, the sizes of the remaining groups vary from chunk to chunk
+            cache = _BULK_STATEMENT_CACHE if len(group) == chunk_size else None
+            factory = partial(_upsert_statement, table, conflict, returning_columns, ordered_columns, len(group))
+            statement = (cache.get((table, conflict, ordered_columns, len(group), returning_columns), factory)
+                         if cache is not None else factory())
+            result = _execute_cached(session, statement, dict(('%s_%d' % (name, row), value)
+                                                              for row, entry_dict in enumerate(group)
+                                                              for name, value in entry_dict.items()), cache)
+            rowcount += max(result.rowcount, 0)
+            if returning_columns:
+                returned.update((tuple(row[name] for name in key_columns), row) for row in result)
+        if rows is not None:
+            rows.extend(returned.get(tuple(entry_dict.get(name) for name in key_columns))
+                        for entry_dict in chunk_dicts)
+    return UpsertResult(rowcount, rows)
+
+
+def insert_or_update_many(session: Session,
+                          model: declarative_base,
+                          entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                          column: Union[str, Sequence[str]],
+                          update_fields: Optional[Set[str]] = None,
+                          exclude_fields: Optional[Set[str]] = None,
+                          returning: Optional[Sequence[str]] = None,
+                          chunk_size: int = 1000,
+                          flush: bool = False,
+                          only_changed: bool = False) -> UpsertResult:
+    # pylint: disable=too-many-arguments
+    """
+    postgresql specific bulk insert or update logic, sends the entries as chunked multi-row `INSERT ... VALUES`
+    :param session: the session to execute the statements in
+    :param model: the declarative class of the entries
+    :param entries: model instances or dicts with column names as keys, `None` values are skipped like in
+                    `insert_or_update`
+    :param column: the conflict target, either `'a, b'` or a sequence of column names
+    :param update_fields: fields to update on conflict, defaults to all fields provided by an entry
+    :param exclude_fields: fields to never update on conflict
+    :param returning: names of columns to return, the rows are mapped back to the order of `entries`
+    :param chunk_size: maximum number of entries sent per statement
+    :param flush: flush the session afterwards
+    :param only_changed: skip updates that wouldn't change any value, such rows aren't counted or returned
+    :return: the number of inserted or modified rows and, if `returning` was given, one row (or `None`) per entry
+    """
+    key_columns = _conflict_columns(column)
+    excluded = set(exclude_fields or set())
+    table = model.__table__
+
+    def _append_update(columns: FrozenSet[str]) -> str:
+        fields = set(columns if update_fields is None else update_fields).difference(excluded)
+        return _on_conflict_update(table, ', '.join(key_columns), fields, only_changed)
+
+    result = _insert_many(session, model, entries, _append_update, key_columns, returning, chunk_size,
+                          deduplicate=True)
+    if flush:
+        session.flush()
+    return result
+
+
+def insert_or_ignore_many(session: Session,
+                          model: declarative_base,
+                          entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                          column: Optional[Union[str, Sequence[str]]] = None,
+                          returning: Optional[Sequence[str]] = None,
+                          chunk_size: int = 1000,
+                          flush: bool = False) -> UpsertResult:
+    # pylint: disable=too-many-arguments
+    """
+    postgresql specific bulk insert or ignore logic, sends the entries as chunked multi-row `INSERT ... VALUES`
+    :param session: the session to execute the statements in
+    :param model: the declarative class of the entries
+    :param entries: model instances or dicts with column names as keys
+    :param column: optional conflict target, either `'a, b'` or a sequence of column names. required for `returning`
+    :param returning: names of columns to return, mapped back to the order of `entries`. ignored entries map to `None`
+    :param chunk_size: maximum number of entries sent per statement
+    :param flush: flush the session afterwards
+    :return: the number of inserted rows and, if `returning` was given, one row (or `None`) per entry
+    """
+    key_columns = _conflict_columns(column) if column else ()
+    append_string = (ON_CONFLICT_TARGET_DO_NOTHING % dict(column=', '.join(key_columns))
+                     if key_columns else ON_CONFLICT_DO_NOTHING)
+    result = _insert_many(session, model, entries, lambda _: append_string, key_columns, returning,
+                          chunk_size)
+    if flush:
+        session.flush()
+    return result
+
+
+def _flag(value: Union[bool, str]) -> bool:
+    """:return: `value` as boolean, config strings like `true` or `0` are parsed"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 def create_engine(username: str, password: str, database: str, host: str = 'localhost', port: int = 5432,
-                  **kwargs: Any) -> Engine:
+                  instrument: Union[bool, str] = False, **kwargs: Any) -> Engine:
+    # pylint: disable=too-many-arguments
     """
     Create a sqlalchemy engine.
     :param username: username used to connect to db
@@ -90,37 +458,220 @@ def create_engine(username: str, password: str, database: str, host: str = 'loca
     :param database: the db used
     :param host: the db host
     :param port: the db port
+    :param instrument: collect pool and query metrics, see `common.db.instrumentation`. config strings like `true`
+                       or `0` are parsed as boolean
     :param kwargs: additional arguments for the engine creation
     :return: a new sqlalchemy engine
     """
     url = 'postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port, database)
-    return sqlalchemy.create_engine(url, client_encoding='utf8', **kwargs)
+    engine = sqlalchemy.create_engine(url, client_encoding='utf8', **kwargs)
+    if _flag(instrument):
+        from . import instrumentation  # pylint: disable=cyclic-import
+        instrumentation.instrument(engine)
+    return engine
 
 
-def default_engine(**kwargs: Any) -> Engine:
+def default_engine(section: str = DEFAULT_ENGINE, **kwargs: Any) -> Engine:
     """
     Create a new sqlalchemy engine based on default values provided via the config.ini
+    :param section: the config section holding the connection parameters
     :param kwargs: add/override additional engine arguments
     :return: sqlalchemy engine
     """
     config = get_config()
-    parameters = dict(config.items('DB'))
+    parameters = dict(config.items(section))
     parameters.update(kwargs)
     return create_engine(**parameters)
 
 
 Base: declarative_base = declarative_base()  # pylint: disable=invalid-name
 
-ENGINE = default_engine()
-_SESSIONMAKER = sessionmaker(bind=ENGINE, autocommit=False)
 
-register_after_fork(ENGINE, Engine.dispose)
+_ENGINE_LOCK = threading.Lock()
+_ENGINE_OPTIONS = {}  # type: Dict[str, Dict[str, Any]]
+_ENGINES = {}  # type: Dict[str, Engine]
+_SESSIONMAKERS = {}  # type: Dict[str, sessionmaker]
+
+
+def _dispose_after_fork(engine: Engine) -> None:
+    """drop the connections inherited by forked child processes, `multiprocessing` is imported only when needed"""
+    from multiprocessing.util import register_after_fork
+    register_after_fork(engine, Engine.dispose)
+
+
+def configure_engine(name: str = DEFAULT_ENGINE, **kwargs: Any) -> None:
+    """
+    Set additional engine arguments, e.g. pool settings, for the named engine. Has to be called before first use.
+    :param name: the name of the engine, equals the config section holding the connection parameters
+    :param kwargs: add/override additional engine arguments
+    """
+    with _ENGINE_LOCK:
+        if name in _ENGINES:
+            raise RuntimeError('engine %s was already created' % name)
+        _ENGINE_OPTIONS[name] = kwargs
+
+
+def get_engine(name: str = DEFAULT_ENGINE) -> Engine:
+    """
+    The engine is created lazily on first use and disposed in forked child processes.
+    :param name: the name of the engine, equals the config section holding the connection parameters
+    :return: the shared sqlalchemy engine for `name`
+    """
+    engine = _ENGINES.get(name)
+    if engine is None:
+        with _ENGINE_LOCK:
+            engine = _ENGINES.get(name)
+            if engine is None:
+                engine = default_engine(name, **_ENGINE_OPTIONS.get(name, {}))
+                _dispose_after_fork(engine)
+                _SESSIONMAKERS[name] = sessionmaker(bind=engine, autocommit=False)
+                _ENGINES[name] = engine
+    return engine
+
+
+def __getattr__(name: str) -> Any:
+    """keep `ENGINE` available for existing imports, without creating it at import time"""
+    if name == 'ENGINE':
+        return get_engine()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+class ReplicaSet:
+    """
+    Engines of the read replicas of a primary. Connections are balanced round robin or to the replica with the least
+    checked out connections. A replica failing to connect is skipped for `retry_interval` seconds, without any
+    replica available the primary is used.
+    """
+
+    def __init__(self,
+                 engines: Sequence[Engine],
+                 primary: Engine,
+                 balancing: str = ROUND_ROBIN,
+                 retry_interval: float = 30.0) -> None:
+        """
+        :param engines: the replica engines
+        :param primary: the engine used if no replica is available
+        :param balancing: `ROUND_ROBIN` or `LEAST_CONNECTIONS`
+        :param retry_interval: seconds a failed replica is skipped
+        """
+        if balancing not in (ROUND_ROBIN, LEAST_CONNECTIONS):
+            raise ValueError('unknown balancing: %s' % balancing)
+        self.engines = list(engines)
+        self.primary = primary
+        self._balancing = balancing
+        self._retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down_until = {}  # type: Dict[int, float]
+
+    def _candidates(self) -> List[int]:
+        """:return: indices of the available replicas in the order they should be tried"""
+        now = time.monotonic()
+        with self._lock:
+            available = [index for index in range(len(self.engines)) if self._down_until.get(index, 0.0) <= now]
+            if self._balancing == ROUND_ROBIN:
+                self._next = (self._next + 1) % max(len(self.engines), 1)
+                return sorted(available, key=lambda index: (index - self._next) % len(self.engines))
+        return sorted(available, key=lambda index: self.engines[index].pool.checkedout())
+
+    def connect(self) -> Connection:
+        """:return: a connection to a replica, or to the primary if none is available"""
+        for index in self._candidates():
+            try:
+                return self.engines[index].connect()
+            except sqlalchemy.exc.DBAPIError:
+                logging.warning('replica %r is unavailable', self.engines[index].url, exc_info=True)
+                with self._lock:
+                    self._down_until[index] = time.monotonic() + self._retry_interval
+        return self.primary.connect()
+
+
+_REPLICAS = {}  # type: Dict[str, Optional[ReplicaSet]]
+
+
+def get_replicas(name: str = DEFAULT_ENGINE) -> Optional[ReplicaSet]:
+    """
+    The replicas are configured in the optional `<name>_REPLICA` config section, e.g. `[DB_REPLICA]`. It takes the same
+    parameters as the primary section with `host` being a comma separated list of `host[:port]`. The additional
+    `balancing` option takes `round_robin` (default) or `least_connections`.
+    :param name: the name of the primary engine, see `get_engine`
+    :return: the lazily created replicas of the named engine, `None` if none are configured
+    """
+    if name in _REPLICAS:
+        return _REPLICAS[name]
+    primary = get_engine(name)
+    section = name + REPLICA_SUFFIX
+    with _ENGINE_LOCK:
+        if name not in _REPLICAS:
+            config = get_config()
+            replicas = None
+            if config.has_section(section):
+                parameters = dict(config.items(section))
+                parameters.update(_ENGINE_OPTIONS.get(section, {}))
+                balancing = parameters.pop('balancing', ROUND_ROBIN)
+                engines = []
+                for host in parameters.pop('host').split(','):
+                    host, _, port = host.strip().partition(':')
+                    engine = create_engine(**dict(parameters, host=host, port=port or parameters.get('port', 5432)))
+                    _dispose_after_fork(engine)
+                    engines.append(engine)
+                replicas = ReplicaSet(engines, primary, balancing)
+            _REPLICAS[name] = replicas
+    return _REPLICAS[name]
+
+
+class _RoutingSession(Session):
+    """
+    Reads from a replica until the first write, afterwards everything is routed to the primary. Locking reads
+    (`SELECT ... FOR UPDATE`) count as writes, a hot standby rejects them.
+    """
+
+    def __init__(self, replicas: ReplicaSet, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._replicas = replicas
+        self._replica = None  # type: Optional[Connection]
+        self._wrote = False
+
+    def get_bind(self, mapper: Any = None, clause: Any = None) -> Any:  # pylint: disable=arguments-differ
+        if (not self._wrote and not self._flushing and isinstance(clause, Select)
+                and clause._for_update_arg is None):  # pylint: disable=protected-access
+            if self._replica is None:
+                self._replica = self._replicas.connect()
+            return self._replica
+        self._wrote = True
+        return super().get_bind(mapper, clause)
+
+    def close(self) -> None:
+        super().close()
+        if self._replica is not None:
+            self._replica.close()
+            self._replica = None
+        self._wrote = False
 
 
 @contextmanager
-def get_session() -> Generator[Session, None, None]:
-    """:return: a sqlalchemy session for the configured database"""
-    session = _SESSIONMAKER()
+def get_session(name: str = DEFAULT_ENGINE,
+                readonly: bool = False,
+                read_your_writes: bool = False) -> Generator[Session, None, None]:
+    """
+    :param name: the name of the engine to use, see `get_engine`
+    :param readonly: route the session to a replica, see `get_replicas`
+    :param read_your_writes: route reads to a replica until the session writes for the first time, excludes
+                             `readonly`
+    :return: a sqlalchemy session for the configured database
+    """
+    if readonly and read_your_writes:
+        raise ValueError('readonly and read_your_writes are mutually exclusive')
+    engine = get_engine(name)
+    replicas = get_replicas(name) if readonly or read_your_writes else None
+    connection = None
+    if replicas is None:
+        session = _SESSIONMAKERS[name]()
+    elif readonly:
+        connection = replicas.connect()
+        session = _SESSIONMAKERS[name](bind=connection)
+    else:
+        session = _RoutingSession(replicas, bind=engine, autocommit=False)
 
     try:
         yield session
@@ -129,3 +680,127 @@ def get_session() -> Generator[Session, None, None]:
         session.rollback()
     finally:
         session.close()
+        if connection is not None:
+            connection.close()
+
+
+class BulkWriter:
+    """
+    Writes items in sub batches of `savepoint_every` items, each wrapped in a SAVEPOINT, and commits every
+    `commit_every` items. A failing sub batch is rolled back to its savepoint and bisected until the offending items are
+    isolated, they are collected in `failures` while all other items are written.
+    """
+
+    def __init__(self,
+                 session: Session,
+                 write: Callable[[Session, Any], Any] = Session.add,
+                 commit_every: int = 1000,
+                 savepoint_every: int = 100) -> None:
+        """
+        :param session: the session to write with
+        :param write: callable of the form (session, item) -> Any writing a single item, defaults to `Session.add`
+        :param commit_every: number of items after which the transaction is committed
+        :param savepoint_every: number of items per savepoint, must be > 0
+        """
+        assert savepoint_every > 0, "savepoint_every must be at least 1"
+        self.session = session
+        self.failures = []  # type: List[BulkFailure]
+        self.written = 0
+        self._write = write
+        self._commit_every = commit_every
+        self._savepoint_every = savepoint_every
+        self._pending = []  # type: List[Any]
+        self._uncommitted = 0
+
+    def add(self, item: Any) -> None:
+        """:param item: the item to write"""
+        self._pending.append(item)
+        if len(self._pending) >= self._savepoint_every:
+            self._write_pending()
+            if self._uncommitted >= self._commit_every:
+                self.flush()
+
+    def add_all(self, items: Iterable[Any]) -> None:
+        """:param items: the items to write, e.g. a `Buffered` batch"""
+        for item in items:
+            self.add(item)
+
+    def flush(self) -> None:
+        """write all pending items and commit"""
+        self._write_pending()
+        self.session.commit()
+        self._uncommitted = 0
+
+    def _write_pending(self) -> None:
+        pending, self._pending = self._pending, []
+        if pending:
+            self._write_batch(pending)
+            self._uncommitted += len(pending)
+
+    def _write_batch(self, batch: List[Any]) -> None:
+        try:
+            with self.session.begin_nested():
+                for item in batch:
+                    self._write(self.session, item)
+        except Exception as err:  # pylint: disable=broad-except
+            if len(batch) == 1:
+                logging.warning('could not write %r: %s', batch[0], err)
+                self.failures.append(BulkFailure(batch[0], err))
+                return
+            middle = len(batch) // 2
+            self._write_batch(batch[:middle])
+            self._write_batch(batch[middle:])
+            return
+        self.written += len(batch)
+
+
+@contextmanager
+def get_bulk_session(write: Callable[[Session, Any], Any] = Session.add,
+                     commit_every: int = 1000,
+                     savepoint_every: int = 100,
+                     name: str = DEFAULT_ENGINE) -> Generator[BulkWriter, None, None]:
+    """
+    Session mode for long running batch writes, see `BulkWriter`. Pending items are written and committed on exit.
+    :param write: callable of the form (session, item) -> Any writing a single item, defaults to `Session.add`
+    :param commit_every: number of items after which the transaction is committed
+    :param savepoint_every: number of items per savepoint
+    :param name: the name of the engine to use, see `get_engine`
+    :return: the writer, failed items are available via `BulkWriter.failures`
+    """
+    with get_session(name) as session:
+        writer = BulkWriter(session, write, commit_every, savepoint_every)
+        yield writer
+        writer.flush()
+
+
+def stream_query(query: Union[Query, Executable],
+                 chunk_size: int = 1000,
+                 name: str = DEFAULT_ENGINE) -> Iterator[Any]:
+    """
+    Iterate over the results of a large query using a server side (named) cursor, fetching `chunk_size` rows at a
+    time. The cursor lives on its own connection and transaction, commits or rollbacks of the session (e.g. done by a
+    `Buffered` handler or `get_session`) don't invalidate it. ORM objects therefore belong to a separate, read only
+    session, use `Session.merge` to modify them.
+    :param query: an ORM query, yields ORM objects/tuples, or a core selectable, yields rows
+    :param chunk_size: number of rows fetched per round trip
+    :param name: the name of the engine used for core selectables and unbound queries, see `get_engine`
+    :return: iterator over the results, e.g. to be used with `Buffered(stream_query(query), handler, chunk_size)`
+    """
+    assert chunk_size > 0, "chunk_size must be at least 1"
+    bind = query.session.get_bind() if isinstance(query, Query) and query.session else get_engine(name)
+    connection = bind.engine.connect()
+    transaction = connection.begin()
+    stream_session = Session(bind=connection, autocommit=False)
+    try:
+        if isinstance(query, Query):
+            yield from query.with_session(stream_session).yield_per(chunk_size)
+        else:
+            result = connection.execution_options(stream_results=True).execute(query)
+            rows = result.fetchmany(chunk_size)
+            while rows:
+                yield from rows
+                rows = result.fetchmany(chunk_size)
+    finally:
+        stream_session.close()
+        transaction.rollback()
+        connection.close()
@@ -0,0 +1,118 @@
+"""
+asyncio counterparts of the engine, session and upsert helpers of `common.db`. Based on `sqlalchemy.ext.asyncio`, which
+requires sqlalchemy>=1.4 and asyncpg, both installed via the `async` extra. The same config sections as for the
+synchronous engines are used.
+"""
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, Optional, Set, Union
+
+from sqlalchemy.engine import Result
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine as _create_async_engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from . import DEFAULT_ENGINE, _flag, _insert_or_ignore_statement, _insert_or_update_statement
+from ..config import get_config
+
+
+def create_async_engine(username: str, password: str, database: str, host: str = 'localhost', port: int = 5432,
+                        instrument: Union[bool, str] = False, **kwargs: Any) -> AsyncEngine:
+    # pylint: disable=too-many-arguments
+    """
+    Create an asyncio sqlalchemy engine using asyncpg.
+    :param username: username used to connect to db
+    :param password: password used to connect to db
+    :param database: the db used
+    :param host: the db host
+    :param port: the db port
+    :param instrument: collect pool and query metrics, like `common.db.create_engine`
+    :param kwargs: additional arguments for the engine creation
+    :return: a new asyncio sqlalchemy engine
+    """
+    url = 'postgresql+asyncpg://{}:{}@{}:{}/{}'.format(username, password, host, port, database)
+    engine = _create_async_engine(url, **kwargs)
+    if _flag(instrument):
+        from . import instrumentation  # pylint: disable=cyclic-import
+        instrumentation.instrument(engine.sync_engine)  # the events are emitted by the proxied synchronous engine
+    return engine
+
+
+def default_async_engine(section: str = DEFAULT_ENGINE, **kwargs: Any) -> AsyncEngine:
+    """
+    Create a new asyncio sqlalchemy engine based on default values provided via the config.ini
+    :param section: the config section holding the connection parameters
+    :param kwargs: add/override additional engine arguments
+    :return: asyncio sqlalchemy engine
+    """
+    config = get_config()
+    parameters = dict(config.items(section))
+    parameters.update(kwargs)
+    return create_async_engine(**parameters)
+
+
+_ASYNC_ENGINES = {}  # type: Dict[str, AsyncEngine]
+
+
+def get_async_engine(name: str = DEFAULT_ENGINE, **kwargs: Any) -> AsyncEngine:
+    """
+    The engine is created lazily on first use. Its pool is bound to the running event loop, use `dispose_async_engines`
+    before switching loops.
+    :param name: the name of the engine, equals the config section holding the connection parameters
+    :param kwargs: additional engine arguments, only used when the engine is created
+    :return: the shared asyncio sqlalchemy engine for `name`
+    """
+    engine = _ASYNC_ENGINES.get(name)
+    if engine is None:
+        engine = _ASYNC_ENGINES[name] = default_async_engine(name, **kwargs)
+    return engine
+
+
+async def dispose_async_engines() -> None:
+    """dispose and forget all shared asyncio engines"""
+    while _ASYNC_ENGINES:
+        _, engine = _ASYNC_ENGINES.popitem()
+        await engine.dispose()
+
+
+@asynccontextmanager
+async def get_async_session(name: str = DEFAULT_ENGINE) -> AsyncGenerator[AsyncSession, None]:
+    """
+    :param name: the name of the engine to use, see `get_async_engine`
+    :return: an asyncio sqlalchemy session for the configured database
+    """
+    session = AsyncSession(get_async_engine(name), expire_on_commit=False)
+
+    try:
+        yield session
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('caught exception in db context, rolling back transaction')
+        await session.rollback()
+    finally:
+        await session.close()
+
+
+async def insert_or_update_async(session: AsyncSession,
+                                 entry: declarative_base,
+                                 column: str,
+                                 update_fields: Optional[Set[str]] = None,
+                                 exclude_fields: Optional[Set[str]] = None,
+                                 flush: bool = False,
+                                 only_changed: bool = False) -> Result:
+    # pylint: disable=too-many-arguments
+    """postgresql specific insert or update logic, see `insert_or_update`"""
+    result = await session.execute(*_insert_or_update_statement(entry, column, update_fields, exclude_fields,
+                                                                only_changed))
+    if flush:
+        await session.flush()
+    return result
+
+
+async def insert_or_ignore_async(session: AsyncSession,
+                                 entry: declarative_base,
+                                 flush: bool = False,
+                                 returning: Optional[str] = None) -> Result:
+    """postgresql specific insert or ignore logic, see `insert_or_ignore`"""
+    result = await session.execute(*_insert_or_ignore_statement(entry, returning))
+    if flush:
+        await session.flush()
+    return result
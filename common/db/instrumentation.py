@@ -0,0 +1,206 @@
+"""
+Opt-in instrumentation of sqlalchemy engines based on engine and pool events. Records pool checkouts, checkout wait
+and per statement latency histograms and keeps a log of slow queries. Engines that aren't instrumented carry no
+listeners at all.
+"""
+import re
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import deque, namedtuple
+from functools import lru_cache
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SlowQuery = namedtuple('SlowQuery', ['timestamp', 'duration', 'fingerprint', 'statement'])
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+|\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+_QUERY_START = 'instrumentation_query_start'
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """:return: the statement with literals, parameters and value lists replaced, e.g. `WHERE id IN (...)`"""
+    normalized = _LITERALS.sub('?', statement)
+    normalized = _LISTS.sub('(...)', normalized)
+    return _WHITESPACE.sub(' ', normalized).strip()
+
+
+class Histogram:
+    """Fixed bucket histogram, the buckets are upper bounds in seconds"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """:param value: the observed duration"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """:return: cumulative bucket counts (the last bucket is `inf`), number and sum of observations"""
+        cumulative = []  # type: List[int]
+        for count in self.counts:
+            cumulative.append(count + (cumulative[-1] if cumulative else 0))
+        return dict(buckets=list(zip(self.buckets + (float('inf'),), cumulative)), count=self.count, sum=self.sum)
+
+
+class EngineMetrics:
+    # pylint: disable=too-many-instance-attributes
+    """Metrics of a single instrumented engine, see `instrument`."""
+
+    def __init__(self,
+                 engine: Engine,
+                 slow_query_threshold: float = 1.0,
+                 slow_query_log_size: int = 100,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self._engine = weakref.ref(engine)
+        self._lock = threading.Lock()
+        self._buckets = tuple(buckets)
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_queries = deque(maxlen=slow_query_log_size)  # type: Deque[SlowQuery]
+        self.checkout_wait = Histogram(self._buckets)
+        self.queries = {}  # type: Dict[str, Histogram]
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.errors = 0
+        self._listeners = [
+            (False, 'before_cursor_execute', self._before_cursor_execute),
+            (False, 'after_cursor_execute', self._after_cursor_execute),
+            (False, 'handle_error', self._handle_error),
+            (False, 'engine_disposed', self._engine_disposed),
+            (True, 'connect', self._connect),
+            (True, 'checkout', self._checkout),
+            (True, 'checkin', self._checkin),
+        ]
+        for on_pool, identifier, listener in self._listeners:
+            event.listen(engine.pool if on_pool else engine, identifier, listener)
+        self._wrap_pool_connect()
+
+    def _wrap_pool_connect(self) -> None:
+        """the pool has no event before a checkout, time `Pool._do_get` directly to measure the wait"""
+        engine = self._engine()
+        do_get = engine.pool._do_get  # type: Callable[[], Any]  # pylint: disable=protected-access
+
+        def _timed_do_get() -> Any:
+            start = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                duration = time.perf_counter() - start
+                with self._lock:
+                    self.checkout_wait.observe(duration)
+
+        engine.pool._do_get = _timed_do_get  # pylint: disable=protected-access
+
+    def _engine_disposed(self, _: Engine) -> None:
+        # pool events are carried over to the recreated pool, the timing wrapper is not
+        self._wrap_pool_connect()
+
+    def _connect(self, *_: Any) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def _checkout(self, *_: Any) -> None:
+        with self._lock:
+            self.checkouts += 1
+
+    def _checkin(self, *_: Any) -> None:
+        with self._lock:
+            self.checkins += 1
+
+    def _before_cursor_execute(self, conn: Any, *_: Any) -> None:
+        conn.info.setdefault(_QUERY_START, []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn: Any, _: Any, statement: str, *__: Any) -> None:
+        duration = time.perf_counter() - conn.info[_QUERY_START].pop()
+        key = fingerprint(statement)
+        with self._lock:
+            histogram = self.queries.get(key)
+            if histogram is None:
+                histogram = self.queries[key] = Histogram(self._buckets)
+            histogram.observe(duration)
+            if duration >= self.slow_query_threshold:
+                self.slow_queries.append(SlowQuery(time.time(), duration, key, statement))
+
+    def _handle_error(self, context: Any) -> None:
+        starts = context.connection.info.get(_QUERY_START) if context.connection is not None else None
+        if starts:
+            starts.pop()
+        with self._lock:
+            self.errors += 1
+
+    def pool_status(self) -> Dict[str, Optional[int]]:
+        """:return: current size, checked out and overflow connections of the pool, `None` if not supported"""
+        engine = self._engine()
+        pool = engine.pool if engine is not None else None
+        status = dict((name, getattr(pool, name, None)) for name in ('size', 'checkedin', 'checkedout', 'overflow'))
+        return dict((name, method() if callable(method) else None) for name, method in status.items())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """:return: a point in time copy of all metrics, e.g. to be scraped by an exporter"""
+        with self._lock:
+            return dict(pool=self.pool_status(),
+                        connects=self.connects,
+                        checkouts=self.checkouts,
+                        checkins=self.checkins,
+                        errors=self.errors,
+                        checkout_wait=self.checkout_wait.snapshot(),
+                        queries=dict((key, histogram.snapshot()) for key, histogram in self.queries.items()),
+                        slow_queries=list(self.slow_queries))
+
+    def remove(self) -> None:
+        """detach all listeners from the engine"""
+        engine = self._engine()
+        if engine is None:
+            return
+        for on_pool, identifier, listener in self._listeners:
+            target = engine.pool if on_pool else engine
+            if event.contains(target, identifier, listener):
+                event.remove(target, identifier, listener)
+        engine.pool.__dict__.pop('_do_get', None)
+
+
+_METRICS = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+def instrument(engine: Engine,
+               slow_query_threshold: float = 1.0,
+               slow_query_log_size: int = 100,
+               buckets: Sequence[float] = DEFAULT_BUCKETS) -> EngineMetrics:
+    """
+    Start collecting metrics for `engine`, instrumenting an engine twice returns the existing metrics.
+    :param engine: the engine to instrument
+    :param slow_query_threshold: statements taking at least this many seconds are added to the slow query log
+    :param slow_query_log_size: number of slow queries kept
+    :param buckets: histogram bucket upper bounds in seconds
+    :return: the metrics of the engine
+    """
+    metrics = _METRICS.get(engine)
+    if metrics is None:
+        metrics = _METRICS[engine] = EngineMetrics(engine, slow_query_threshold, slow_query_log_size, buckets)
+    return metrics
+
+
+def uninstrument(engine: Engine) -> None:
+    """stop collecting metrics for `engine`"""
+    metrics = _METRICS.pop(engine, None)
+    if metrics is not None:
+        metrics.remove()
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """:return: the metrics snapshots of all instrumented engines, keyed by their (password masked) url"""
+    return dict((repr(engine.url), metrics.snapshot()) for engine, metrics in list(_METRICS.items()))
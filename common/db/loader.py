@@ -0,0 +1,215 @@
+"""
+Bulk loading of declarative models via postgres `COPY FROM STDIN`. The entries are streamed into a temporary staging
+table, temporary tables are never WAL logged, and merged into the target table with the usual `ON CONFLICT` logic.
+Missing values of columns with a `server_default` take that default while merging.
+"""
+import datetime
+import enum
+import io
+import json
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Union
+
+from sqlalchemy import types
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import Column, Table
+
+from . import (ON_CONFLICT_DO_NOTHING, ON_CONFLICT_TARGET_DO_NOTHING, _PREPARER, _conflict_columns,
+               _on_conflict_update, model_extractor)
+
+MergeResult = namedtuple('MergeResult', ['inserted', 'updated', 'skipped'])
+
+_NULL = '\\N'
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+_CREATE_STAGE_SQL = 'CREATE TEMPORARY TABLE %(stage)s ON COMMIT DROP AS SELECT %(columns)s FROM %(table)s WITH NO DATA'
+_COPY_SQL = 'COPY %(stage)s (%(columns)s) FROM STDIN'
+_MERGE_SQL = '''
+WITH merged AS (
+    INSERT INTO %(table)s (%(columns)s)
+    %(select)s
+    %(on_conflict)s
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged
+'''
+_DROP_STAGE_SQL = 'DROP TABLE %(stage)s'
+
+_DIALECT = postgresql.dialect()
+
+
+def _array_literal(value: Iterable[Any]) -> str:
+    """:return: postgres array literal, e.g. `{"1","2"}`"""
+    return '{%s}' % ','.join('NULL' if element is None else
+                             '"%s"' % str(element).replace('\\', '\\\\').replace('"', '\\"')
+                             for element in value)
+
+
+def _column_converter(column: Column) -> Callable[[Any], str]:
+    """:return: a function converting python values of `column` into their `COPY` text representation"""
+    default = column.default if column.default is not None and not column.default.is_sequence else None
+
+    def _convert(value: Any) -> str:
+        if value is None and default is not None:
+            value = default.arg(None) if default.is_callable else default.arg
+        if value is None:
+            return _NULL
+        if isinstance(column.type, types.JSON):
+            text = json.dumps(value)
+        elif isinstance(column.type, types.ARRAY):
+            text = _array_literal(value)
+        elif isinstance(value, enum.Enum):
+            text = value.name
+        elif isinstance(value, bool):
+            text = 't' if value else 'f'
+        elif isinstance(value, (datetime.date, datetime.time)):
+            text = value.isoformat()
+        else:
+            text = str(value)
+        return text.translate(_COPY_ESCAPES)
+
+    return _convert
+
+
+def _select_column(column: Column) -> str:
+    """:return: the column as selected from the staging table, missing values of a `server_default` column default"""
+    quoted = _PREPARER.quote(column.name)
+    if column.server_default is None:
+        return quoted
+    default = _DIALECT.ddl_compiler(_DIALECT, None).get_column_default_string(column)
+    return 'COALESCE(%s, %s)' % (quoted, default) if default is not None else quoted
+
+
+def _default_columns(table: Table) -> List[Column]:
+    """:return: all columns except a single serial primary key, which is left to the target table"""
+    primary_keys = list(table.primary_key.columns)
+    return [column for column in table.columns
+            if not (primary_keys == [column] and isinstance(column.type, types.Integer) and column.default is None)]
+
+
+class _CopyStream(io.RawIOBase):
+    """Minimal file like object pulling the `COPY` lines lazily from a generator, keeps memory constant."""
+
+    def __init__(self, lines: Iterator[str]) -> None:
+        super().__init__()
+        self._lines = lines
+        self._buffer = bytearray()
+        self.count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:  # type: ignore
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer.extend(line.encode('utf-8'))
+            self.count += 1
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+
+def _copy_lines(model: declarative_base,
+                entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                columns: List[Column]) -> Iterator[str]:
+    """:return: one `COPY` text format line per entry"""
+    names = [column.name for column in columns]
+    converters = [_column_converter(column) for column in columns]
+    getter = model_extractor(model).tuple_getter(names)
+    for entry in entries:
+        values = tuple(entry.get(name) for name in names) if isinstance(entry, dict) else getter(entry)
+        yield '\t'.join(convert(value) for convert, value in zip(converters, values)) + '\n'
+
+
+def _copy_merge(session: Session,
+                model: declarative_base,
+                entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                on_conflict: Callable[[List[str]], str],
+                distinct_on: Sequence[str],
+                columns: Optional[Sequence[str]]) -> MergeResult:
+    # pylint: disable=too-many-arguments
+    """shared implementation of the copy loaders"""
+    table = model.__table__
+    copy_columns = [table.c[name] for name in columns] if columns else _default_columns(table)
+    column_names = [column.name for column in copy_columns]
+    params = dict(table=_PREPARER.format_table(table),
+                  stage=_PREPARER.quote('_stage_' + table.name),
+                  columns=', '.join(_PREPARER.quote(name) for name in column_names))
+
+    select_columns = ', '.join(_select_column(column) for column in copy_columns)
+    select = 'SELECT %s FROM %s' % (select_columns, params['stage'])
+    if distinct_on:
+        # the last row per key wins, rows with a NULL key never conflict and are all merged
+        keys = ', '.join(_PREPARER.quote(name) for name in distinct_on)
+        not_null = ' AND '.join('%s IS NOT NULL' % _PREPARER.quote(name) for name in distinct_on)
+        select = '(SELECT DISTINCT ON (%s) %s FROM %s WHERE %s ORDER BY %s, ctid DESC) UNION ALL %s WHERE NOT (%s)' % (
+            keys, select_columns, params['stage'], not_null, keys, select, not_null)
+
+    connection = session.connection()
+    connection.execute(_CREATE_STAGE_SQL % params)
+    stream = _CopyStream(_copy_lines(model, entries, copy_columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(_COPY_SQL % params, stream)
+    finally:
+        cursor.close()
+    inserted, updated = connection.execute(
+        _MERGE_SQL % dict(params, select=select, on_conflict=on_conflict(column_names))).fetchone()
+    connection.execute(_DROP_STAGE_SQL % params)
+    return MergeResult(inserted, updated, stream.count - inserted - updated)
+
+
+def copy_insert_or_update(session: Session,
+                          model: declarative_base,
+                          entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                          column: Union[str, Sequence[str]],
+                          update_fields: Optional[Set[str]] = None,
+                          exclude_fields: Optional[Set[str]] = None,
+                          columns: Optional[Sequence[str]] = None,
+                          only_changed: bool = False) -> MergeResult:
+    # pylint: disable=too-many-arguments
+    """
+    `COPY` based counterpart of `insert_or_update_many`. duplicate conflict keys within `entries` are merged, the
+    last one wins. keys containing `NULL` never conflict, such entries are all loaded.
+    :param session: the session to execute the load in, the staging table lives within its transaction
+    :param model: the declarative class of the entries
+    :param entries: model instances or dicts with column names as keys, consumed lazily
+    :param column: the conflict target, either `'a, b'` or a sequence of column names
+    :param update_fields: fields to update on conflict, defaults to all loaded columns
+    :param exclude_fields: fields to never update on conflict
+    :param columns: columns to load, defaults to all columns but a serial primary key
+    :param only_changed: skip updates that wouldn't change any value, such entries are counted as skipped
+    :return: the number of inserted, updated and skipped entries
+    """
+    key_columns = _conflict_columns(column)
+
+    def _on_conflict(column_names: List[str]) -> str:
+        fields = set(column_names if update_fields is None else update_fields).difference(exclude_fields or set())
+        return _on_conflict_update(model.__table__, ', '.join(key_columns), fields, only_changed)
+
+    return _copy_merge(session, model, entries, _on_conflict, key_columns, columns)
+
+
+def copy_insert_or_ignore(session: Session,
+                          model: declarative_base,
+                          entries: Iterable[Union[declarative_base, Dict[str, Any]]],
+                          column: Optional[Union[str, Sequence[str]]] = None,
+                          columns: Optional[Sequence[str]] = None) -> MergeResult:
+    """
+    `COPY` based counterpart of `insert_or_ignore_many`.
+    :param session: the session to execute the load in, the staging table lives within its transaction
+    :param model: the declarative class of the entries
+    :param entries: model instances or dicts with column names as keys, consumed lazily
+    :param column: optional conflict target, either `'a, b'` or a sequence of column names
+    :param columns: columns to load, defaults to all columns but a serial primary key
+    :return: the number of inserted and skipped entries
+    """
+    on_conflict = (ON_CONFLICT_TARGET_DO_NOTHING % dict(column=', '.join(_conflict_columns(column)))
+                   if column else ON_CONFLICT_DO_NOTHING)
+    return _copy_merge(session, model, entries, lambda _: on_conflict, (), columns)
@@ -0,0 +1,3 @@
+DROP INDEX IF EXISTS activity.tagging_tagging_ts_id_index;
+DROP INDEX IF EXISTS activity.data_source_crawled_ts_id_index;
+DROP INDEX IF EXISTS activity.data_crawled_ts_id_index;
@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS data_crawled_ts_id_index ON activity.data (crawled_ts, id);
+CREATE INDEX IF NOT EXISTS data_source_crawled_ts_id_index ON activity.data (source_id, crawled_ts, id);
+CREATE INDEX IF NOT EXISTS tagging_tagging_ts_id_index ON activity.tagging (tagging_ts, id);
@@ -0,0 +1,2 @@
+DROP INDEX IF EXISTS activity.job_oid_key_index;
+ALTER TABLE activity.job DROP COLUMN IF EXISTS key;
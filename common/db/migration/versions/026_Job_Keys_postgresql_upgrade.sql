@@ -0,0 +1,2 @@
+ALTER TABLE activity.job ADD COLUMN IF NOT EXISTS key INTEGER;
+CREATE INDEX IF NOT EXISTS job_oid_key_index ON activity.job (oid, key);
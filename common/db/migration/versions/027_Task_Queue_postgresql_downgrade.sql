@@ -0,0 +1 @@
+DROP TABLE IF EXISTS activity.task;
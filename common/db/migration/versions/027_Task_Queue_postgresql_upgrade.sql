@@ -0,0 +1,20 @@
+CREATE TABLE IF NOT EXISTS activity.task
+(
+    id BIGSERIAL PRIMARY KEY,
+    queue VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    available_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    error VARCHAR
+);
+
+CREATE INDEX IF NOT EXISTS task_dequeue_index ON activity.task (queue, priority DESC, available_at, id)
+    WHERE attempts < max_attempts;
+
+GRANT ALL ON TABLE activity.task TO fanlens;
+GRANT SELECT ON TABLE activity.task TO "read.data";
+GRANT UPDATE, INSERT, DELETE ON TABLE activity.task TO "write.data";
+GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA activity to "write.data";
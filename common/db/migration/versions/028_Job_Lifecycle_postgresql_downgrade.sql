@@ -0,0 +1,3 @@
+ALTER TABLE activity.job DROP COLUMN IF EXISTS error;
+ALTER TABLE activity.job DROP COLUMN IF EXISTS outcome;
+ALTER TABLE activity.job DROP COLUMN IF EXISTS finished;
@@ -0,0 +1,4 @@
+ALTER TABLE activity.job ADD COLUMN IF NOT EXISTS comment VARCHAR;
+ALTER TABLE activity.job ADD COLUMN IF NOT EXISTS finished TIMESTAMP WITH TIME ZONE;
+ALTER TABLE activity.job ADD COLUMN IF NOT EXISTS outcome VARCHAR(16);
+ALTER TABLE activity.job ADD COLUMN IF NOT EXISTS error VARCHAR;
@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS activity.lease
+(
+    name VARCHAR(64) PRIMARY KEY,
+    holder VARCHAR NOT NULL,
+    acquired_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+GRANT ALL ON TABLE activity.lease TO fanlens;
+GRANT SELECT ON TABLE activity.lease TO "read.data";
+GRANT UPDATE, INSERT, DELETE ON TABLE activity.lease TO "write.data";
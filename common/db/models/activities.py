@@ -5,7 +5,7 @@ from typing import Any
 import datetime
 import enum
 
-from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.orm import relationship, backref
 
@@ -117,6 +117,8 @@ class Data(Base):
 
     __table_args__ = (
         UniqueConstraint(object_id, source_id),
+        Index(__tablename__ + "_crawled_ts_id_index", crawled_ts, id),
+        Index(__tablename__ + "_source_crawled_ts_id_index", source_id, crawled_ts, id),
         {'schema': SCHEMA},
     )
 
@@ -273,6 +275,7 @@ class Tagging(Base):
 
     __table_args__ = (
         UniqueConstraint(data_id, tag_id),
+        Index(__tablename__ + "_tagging_ts_id_index", tagging_ts, id),
         {'schema': SCHEMA},
     )
 
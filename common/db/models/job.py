@@ -2,7 +2,8 @@
 """Job related ORM classes"""
 import datetime
 
-from sqlalchemy import Column, Integer, BigInteger, Boolean, DateTime, String, Index
+from sqlalchemy import Column, Integer, BigInteger, Boolean, DateTime, String, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
 
 from .. import Base
 from ..models.activities import SCHEMA
@@ -16,11 +17,51 @@ class Job(Base):
     owner = Column(String, nullable=False)
     pid = Column(Integer, nullable=False)
     oid = Column(BigInteger, nullable=False)
+    key = Column(Integer, nullable=True)
     granted = Column(Boolean, nullable=False)
     timestamp = Column(DateTime(timezone=True), nullable=False, default=datetime.datetime.utcnow)
     comment = Column(String, nullable=True)
+    finished = Column(DateTime(timezone=True), nullable=True)
+    outcome = Column(String(length=16), nullable=True)
+    error = Column(String, nullable=True)
 
     __table_args__ = (
         Index(__tablename__ + "_date_index", timestamp),
+        Index(__tablename__ + "_oid_key_index", oid, key),
         {'schema': SCHEMA}
     )
+
+
+class Task(Base):
+    """A unit of work in a queue, see `common.job.queue`. Acknowledged tasks are deleted."""
+    __tablename__ = "task"
+
+    id = Column(BigInteger, primary_key=True)
+    queue = Column(String(length=64), nullable=False)
+    payload = Column(JSONB, nullable=False, default=dict)
+    priority = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    available_at = Column(DateTime(timezone=True), nullable=False, server_default=text('now()'))
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=text('now()'))
+    error = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index(__tablename__ + "_dequeue_index", queue, priority.desc(), available_at, id,
+              postgresql_where=attempts < max_attempts),
+        {'schema': SCHEMA}
+    )
+
+
+class Lease(Base):
+    """A named, expiring lease held by at most one process, see `common.job.leader`."""
+    __tablename__ = "lease"
+
+    name = Column(String(length=64), primary_key=True)
+    holder = Column(String, nullable=False)
+    acquired_at = Column(DateTime(timezone=True), nullable=False, server_default=text('now()'))
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        {'schema': SCHEMA},
+    )
@@ -0,0 +1,93 @@
+"""
+Keyset (seek) pagination. Instead of `OFFSET`/`LIMIT` the next page is selected by comparing against the keys of the
+last seen row, e.g. `(crawled_ts, id) > (:crawled_ts, :id)`, which an index on the keys answers in constant time.
+"""
+import base64
+import json
+from collections import namedtuple
+from typing import Any, List, Optional, Sequence, Tuple
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+from .models.activities import Data, Tagging
+from .models.brain import Prediction
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'previous_cursor'])
+
+_FORWARD = '>'
+_BACKWARD = '<'
+
+
+def _encode_cursor(direction: str, values: Sequence[Any]) -> str:
+    """:return: an opaque, url safe cursor"""
+    payload = json.dumps([direction, list(values)], default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, List[Any]]:
+    """:return: direction and key values of the cursor"""
+    try:
+        direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError) as err:
+        raise ValueError('invalid cursor: %s' % cursor) from err
+    if direction not in (_FORWARD, _BACKWARD):
+        raise ValueError('invalid cursor: %s' % cursor)
+    return direction, values
+
+
+class KeysetPaginator:
+    """Paginates queries by a unique combination of indexed columns. Cursors can be followed in both directions."""
+
+    def __init__(self, keys: Sequence[InstrumentedAttribute], descending: bool = False) -> None:
+        """
+        :param keys: the ordering columns, the last one has to make the order unique, e.g. `(Data.crawled_ts, Data.id)`
+        :param descending: order all keys descending, e.g. newest first
+        """
+        assert keys, "at least one key column is required"
+        self._keys = tuple(keys)
+        self._descending = descending
+
+    def _seek(self, query: Query, ascending: bool, values: Optional[List[Any]]) -> Query:
+        """:return: the query ordered by the keys, starting after `values`"""
+        if values is not None:
+            if len(values) != len(self._keys):
+                raise ValueError('cursor does not match the paginator keys')
+            if len(self._keys) == 1:
+                column, value = self._keys[0], values[0]
+            else:
+                column, value = tuple_(*self._keys), tuple(values)
+            query = query.filter(column > value if ascending else column < value)
+        return query.order_by(None).order_by(*[key.asc() if ascending else key.desc() for key in self._keys])
+
+    def _cursor(self, direction: str, item: Any) -> str:
+        return _encode_cursor(direction, [getattr(item, key.key) for key in self._keys])
+
+    def page(self, query: Query, per_page: int, cursor: Optional[str] = None) -> Page:
+        """
+        :param query: the filtered query to paginate, an existing ordering is replaced
+        :param per_page: maximum number of items per page
+        :param cursor: a cursor of a previously returned `Page`, `None` for the first page
+        :return: the items of the page together with the cursors of the following and the previous page (or `None`)
+        """
+        assert per_page > 0, "per_page must be at least 1"
+        direction, values = _decode_cursor(cursor) if cursor else (_FORWARD, None)
+        forward = direction == _FORWARD
+        items = self._seek(query, forward != self._descending, values).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if not forward:
+            items.reverse()
+        if not items:
+            return Page(items, None, None)
+        has_next = has_more if forward else True
+        has_previous = values is not None if forward else has_more
+        return Page(items,
+                    self._cursor(_FORWARD, items[-1]) if has_next else None,
+                    self._cursor(_BACKWARD, items[0]) if has_previous else None)
+
+
+DATA_PAGINATOR = KeysetPaginator((Data.crawled_ts, Data.id))
+TAGGING_PAGINATOR = KeysetPaginator((Tagging.tagging_ts, Tagging.id))
+PREDICTION_PAGINATOR = KeysetPaginator((Prediction.id,))
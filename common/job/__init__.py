@@ -1,18 +1,21 @@
 """ Tools for exclusive jobs backed by postgres advisory locks"""
 import datetime
 import logging
+import random
+import time
 import uuid
 from collections import namedtuple
 from contextlib import contextmanager, suppress
 from enum import Enum
-from typing import Callable, Optional, Generator, TypeVar, Any
+from typing import Callable, Optional, Generator, TypeVar, Any, Dict, Iterable, List, Sequence, Union
 from functools import wraps
 
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from sqlalchemy.pool import NullPool
 
-from ..db import default_engine
+from ..db import default_engine, get_engine
 from ..db.models.job import Job
 
 
@@ -24,58 +27,256 @@ class Space(Enum):
     CRAWLER = 4
 
 
-_START_JOB_SQL = text('''
-INSERT INTO activity.job(owner, pid, oid, granted, timestamp)
-SELECT CURRENT_USER, pg_backend_pid(), :oid, pg_try_advisory_lock(:oid), CASE WHEN :timestamp IS NULL THEN now() ELSE :timestamp END
-RETURNING *
+class LockMode(Enum):
+    """How the advisory lock of an exclusive run is held"""
+    SESSION = 1  # `pg_try_advisory_lock` on a dedicated, unpooled connection
+    TRANSACTION = 2  # `pg_try_advisory_xact_lock` within a single transaction, works with pooled connections/PgBouncer
+
+
+class WaitMode(Enum):
+    """How an exclusive run waits for a taken lock, only used if a timeout is given"""
+    BACKOFF = 1  # retry `pg_try_advisory_lock` with jittered exponential backoff, client side
+    BLOCKING = 2  # block in `pg_advisory_lock`, bounded server side by `lock_timeout`
+
+
+class LockNotGranted(RuntimeError):
+    """Raised by the exclusive runs if the lock is held by another run"""
+
+
+class Outcome(Enum):
+    """How a granted exclusive run ended, stored in `Job.outcome`"""
+    SUCCESS = 'success'
+    FAILURE = 'failure'
+
+
+_START_JOB_SQL = '''
+INSERT INTO activity.job(owner, pid, oid, key, granted, timestamp, comment)
+SELECT CURRENT_USER, pg_backend_pid(), :oid, CAST(:key AS INTEGER), %(lock)s,
+       CASE WHEN :timestamp IS NULL THEN now() ELSE :timestamp END, :comment
+RETURNING id, owner, pid, oid, key, granted, timestamp
+'''
+
+_FINISH_JOB_SQL = text('''
+UPDATE activity.job SET finished = now(), outcome = :outcome, error = :error WHERE id = ANY(:ids)
 ''')
 
-Run = namedtuple('Run', ['id', 'engine', 'connection', 'session'])
+_LOCK_FUNCTIONS = {
+    LockMode.SESSION: 'pg_try_advisory_lock',
+    LockMode.TRANSACTION: 'pg_try_advisory_xact_lock',
+}
+
+_BLOCKING_LOCK_FUNCTIONS = {
+    LockMode.SESSION: 'pg_advisory_lock',
+    LockMode.TRANSACTION: 'pg_advisory_xact_lock',
+}
+
+
+def _lock_expression(function: str, keyed: bool) -> str:
+    # the two int form `pg_try_advisory_lock(int, int)` lives in a separate lock space than the single bigint form,
+    # keyed and unkeyed runs of the same `Space` don't exclude each other
+    return '%s(CAST(:oid AS INTEGER), CAST(:key AS INTEGER))' % function if keyed else '%s(:oid)' % function
 
 
-def _init_exclusive_run() -> Run:
+_START_JOB_SQLS = dict(((mode, keyed), text(_START_JOB_SQL % dict(lock=_lock_expression(function, keyed))))
+                       for mode, function in _LOCK_FUNCTIONS.items() for keyed in (False, True))
+
+_LOCK_SQLS = dict(((function, keyed), text('SELECT %s' % _lock_expression(function, keyed)))
+                  for functions in (_LOCK_FUNCTIONS, _BLOCKING_LOCK_FUNCTIONS)
+                  for function in functions.values() for keyed in (False, True))
+
+_SET_LOCK_TIMEOUT_SQL = text("SELECT set_config('lock_timeout', :timeout, true)")
+_RESET_LOCK_TIMEOUT_SQL = text('SET LOCAL lock_timeout TO DEFAULT')
+
+BACKOFF_INITIAL = 0.05
+BACKOFF_MAX = 2.0
+
+MIN_KEY = -2 ** 31
+MAX_KEY = 2 ** 31 - 1
+
+Run = namedtuple('Run', ['id', 'engine', 'connection', 'session', 'waited'])
+KeyedRun = namedtuple('KeyedRun', ['id', 'engine', 'connection', 'session', 'waited', 'keys'])
+RunReport = namedtuple('RunReport', ['ran', 'waited', 'result'])
+
+
+def _check_key(key: Optional[int]) -> None:
+    if key is not None and not MIN_KEY <= key <= MAX_KEY:
+        raise ValueError('key %d doesn\'t fit into a 4 byte integer' % key)
+
+
+def _init_exclusive_run(mode: LockMode = LockMode.SESSION) -> Run:
     run_id = uuid.uuid1()
-    engine = default_engine(poolclass=NullPool)
+    engine = get_engine() if mode == LockMode.TRANSACTION else default_engine(poolclass=NullPool)
     connection = engine.connect()
     session = Session(bind=connection, autocommit=False)
-    return Run(run_id, engine, connection, session)
+    return Run(run_id, engine, connection, session, 0.0)
 
 
 def _start_exclusive_run(oid: Space,
                          session: Session,
                          timestamp: Optional[datetime.datetime] = None,
-                         lenient: bool = False) -> Job:
-    run_id, run_owner, run_pid, run_oid, run_granted, run_timestamp = session.execute(
-        _START_JOB_SQL, params=dict(oid=oid.value, timestamp=timestamp)).fetchone()
-    session.commit()
-    job = Job(id=run_id, owner=run_owner, pid=run_pid, oid=run_oid, granted=run_granted, timestamp=run_timestamp)
+                         lenient: bool = False,
+                         mode: LockMode = LockMode.SESSION,
+                         key: Optional[int] = None,
+                         comment: Optional[str] = None) -> Job:
+    # pylint: disable=too-many-arguments
+    _check_key(key)
+    run_id, run_owner, run_pid, run_oid, run_key, run_granted, run_timestamp = session.execute(
+        _START_JOB_SQLS[mode, key is not None],
+        params=dict(oid=oid.value, key=key, timestamp=timestamp, comment=comment)).fetchone()
+    if mode == LockMode.SESSION or not (run_granted or lenient):
+        # a transaction level lock is held until the transaction ends, the job row is committed together with the run
+        session.commit()
+    job = Job(id=run_id, owner=run_owner, pid=run_pid, oid=run_oid, key=run_key, granted=run_granted,
+              timestamp=run_timestamp, comment=comment)
     if not job.granted and not lenient:
-        raise RuntimeError('couldn\'t grant job for oid: %d' % run_oid)
+        raise LockNotGranted('couldn\'t grant job for oid: %d, key: %s' % (run_oid, run_key))
     return job
 
 
-def _close_exclusive_run(run: Run) -> None:
+def _finish_exclusive_run(run: Run, jobs: Sequence[Job], mode: LockMode, error: Optional[BaseException] = None) -> None:
+    """record the end of the granted jobs of a run, with `LockMode.TRANSACTION` this ends the run transaction"""
+    outcome = Outcome.FAILURE if error is not None else Outcome.SUCCESS
+    message = repr(error) if error is not None else None
+    if error is not None or mode == LockMode.SESSION:
+        # uncommitted work of a session mode run is discarded, just like closing the session would
+        run.session.rollback()
+    if mode == LockMode.TRANSACTION and error is not None:
+        # the job rows were rolled back together with the run, record them on their own
+        for job in jobs:
+            job.finished = datetime.datetime.now(datetime.timezone.utc)
+            job.outcome, job.error = outcome.value, message
+            run.session.add(job)
+    elif jobs:
+        run.session.execute(_FINISH_JOB_SQL, params=dict(ids=[job.id for job in jobs], outcome=outcome.value,
+                                                         error=message))
+    run.session.commit()
+
+
+def _fail_exclusive_run(run: Run, jobs: Sequence[Job], mode: LockMode, error: BaseException) -> None:
+    """record the failure of the granted jobs, errors doing so are logged to not replace `error` of the run"""
+    try:
+        _finish_exclusive_run(run, jobs, mode, error)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('Couldn\'t record the failure of run: %s', run.id)
+
+
+def _close_exclusive_run(run: Run, mode: LockMode = LockMode.SESSION) -> None:
     run.session.close()
     run.connection.close()
-    run.engine.dispose()
+    if mode == LockMode.SESSION:
+        run.engine.dispose()
+
+
+def _wait_for_lock(oid: Space,
+                   session: Session,
+                   mode: LockMode,
+                   key: Optional[int],
+                   timeout: float,
+                   wait: WaitMode) -> float:
+    # pylint: disable=too-many-arguments
+    """
+    wait up to `timeout` seconds until the lock is taken. the lock is re-entrant, `_start_exclusive_run` grants it again
+    :return: the seconds waited
+    """
+    start = time.monotonic()
+    params = dict(oid=oid.value, key=key)
+    keyed = key is not None
+    if wait == WaitMode.BLOCKING:
+        try:
+            session.execute(_SET_LOCK_TIMEOUT_SQL, params=dict(timeout='%dms' % max(1, int(timeout * 1000))))
+            session.execute(_LOCK_SQLS[_BLOCKING_LOCK_FUNCTIONS[mode], keyed], params=params)
+            session.execute(_RESET_LOCK_TIMEOUT_SQL)
+        except OperationalError:  # lock_timeout exceeded, nothing is held yet so the transaction can be dropped
+            session.rollback()
+    else:
+        delay = BACKOFF_INITIAL
+        while not session.execute(_LOCK_SQLS[_LOCK_FUNCTIONS[mode], keyed], params=params).scalar():
+            session.rollback()  # don't idle in a transaction while sleeping
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, random.uniform(0, delay)))
+            delay = min(delay * 2, BACKOFF_MAX)
+    return time.monotonic() - start
 
 
 @contextmanager
-def exclusive_run_ctx(oid: Space) -> Generator[Run, None, None]:
+def exclusive_run_ctx(oid: Space,
+                      mode: LockMode = LockMode.SESSION,
+                      key: Optional[int] = None,
+                      timeout: Optional[float] = None,
+                      wait: WaitMode = WaitMode.BACKOFF,
+                      comment: Optional[str] = None) -> Generator[Run, None, None]:
+    # pylint: disable=too-many-arguments
     """
     exclusive context within the space specified
     :param oid: the space to run in
+    :param mode: how the lock is held. with `LockMode.TRANSACTION` the run is a single transaction on a pooled
+                 connection, `Run.session` is committed on exit, which releases the lock. don't commit it earlier.
+    :param key: optional 4 byte integer to lock only `key` within the space, e.g. a `Source.id`
+    :param timeout: seconds to wait for a taken lock, by default the context is skipped right away
+    :param wait: how to wait for a taken lock, `Run.waited` holds the seconds waited
+    :param comment: stored with the job row, e.g. to tell runs of a space apart
+    raises `LockNotGranted` instead of entering the context if the lock is taken. the job row is finished on exit,
+    recording the outcome and the error if the context raised, the error propagates
     """
-    run = _init_exclusive_run()
+    run = _init_exclusive_run(mode)
+    job = None  # type: Optional[Job]
     try:
-        logging.debug('Starting exclusive job for oid: %d, run: %s', oid.value, run.id)
-        _start_exclusive_run(oid, run.session, lenient=False)  # throws exception if it can't start the job
+        logging.debug('Starting exclusive job for oid: %d, key: %s, run: %s', oid.value, key, run.id)
+        if timeout:
+            _check_key(key)
+            run = run._replace(waited=_wait_for_lock(oid, run.session, mode, key, timeout, wait))
+        # throws exception if it can't start the job
+        job = _start_exclusive_run(oid, run.session, lenient=False, mode=mode, key=key, comment=comment)
         yield run
-    except RuntimeError:
-        logging.debug('Couldn\'t fetch lock for oid: %d, run: %s', oid.value, run.id)
+        started, job = job, None  # don't record a failure if finishing itself fails
+        _finish_exclusive_run(run, [started], mode)
+    except BaseException as err:
+        if job is not None:
+            _fail_exclusive_run(run, [job], mode, err)
+        elif isinstance(err, LockNotGranted):
+            logging.debug('Couldn\'t fetch lock for oid: %d, key: %s, run: %s, waited: %.3fs',
+                          oid.value, key, run.id, run.waited)
+        raise
     finally:
-        _close_exclusive_run(run)
-        logging.debug('Done with exclusive job for oid: %d, run: %s', oid.value, run.id)
+        _close_exclusive_run(run, mode)
+        logging.debug('Done with exclusive job for oid: %d, key: %s, run: %s', oid.value, key, run.id)
+
+
+@contextmanager
+def exclusive_keys_ctx(oid: Space,
+                       candidates: Iterable[int],
+                       limit: Optional[int] = None,
+                       mode: LockMode = LockMode.SESSION) -> Generator[KeyedRun, None, None]:
+    """
+    exclusive context for as many keys of `candidates` as possible, keys held by other runs are skipped. all locks are
+    held on a single connection, e.g. to let several crawler nodes process disjoint sources in parallel
+    :param oid: the space to run in
+    :param candidates: the 4 byte integer keys to try, in order of preference
+    :param limit: stop after acquiring this many keys, `None` tries all candidates
+    :param mode: how the locks are held, see `exclusive_run_ctx`
+    :return: the run, `KeyedRun.keys` lists the acquired keys, it may be empty
+    """
+    run = _init_exclusive_run(mode)
+    jobs = []  # type: List[Job]
+    try:
+        for key in candidates:
+            if limit is not None and len(jobs) >= limit:
+                break
+            job = _start_exclusive_run(oid, run.session, lenient=True, mode=mode, key=key)
+            if job.granted:
+                jobs.append(job)
+        logging.debug('Acquired %d keys for oid: %d, run: %s', len(jobs), oid.value, run.id)
+        yield KeyedRun(*run, keys=[job.key for job in jobs])
+        started, jobs = jobs, []
+        _finish_exclusive_run(run, started, mode)
+    except BaseException as err:
+        _fail_exclusive_run(run, jobs, mode, err)
+        raise
+    finally:
+        _close_exclusive_run(run, mode)
+        logging.debug('Done with exclusive keys for oid: %d, run: %s', oid.value, run.id)
 
 
 _RT = TypeVar('_RT')
@@ -88,22 +289,63 @@ def run_exclusive_job(oid: Space, job: Callable[..., _RT], *args: Any, **kwargs:
     :param job: the callable job to be executed
     :param args: passed to job
     :param kwargs: passed to job
+    :return: the result of the job, `None` if the lock is taken. errors of the job propagate
     """
-    with suppress(RuntimeError), exclusive_run_ctx(oid):
+    with suppress(LockNotGranted), exclusive_run_ctx(oid):
         return job(*args, **kwargs)
 
 
-def runs_exclusive(oid: Space) -> Callable[[Callable], Callable[..., _RT]]:
+def call_exclusive(oid: Space,
+                   job: Callable[..., _RT],
+                   args: Sequence[Any] = (),
+                   kwargs: Optional[Dict[str, Any]] = None,
+                   mode: LockMode = LockMode.SESSION,
+                   key: Optional[int] = None,
+                   timeout: Optional[float] = None,
+                   wait: WaitMode = WaitMode.BACKOFF) -> RunReport:
+    # pylint: disable=too-many-arguments
+    """
+    like `run_exclusive_job`, but optionally waits for the lock and reports whether the job ran
+    :param oid: the space to run in
+    :param job: the callable job to be executed
+    :param args: passed to job
+    :param kwargs: passed to job
+    :param mode: how the lock is held, see `exclusive_run_ctx`
+    :param key: optional key within the space, see `exclusive_run_ctx`
+    :param timeout: seconds to wait for a taken lock
+    :param wait: how to wait for a taken lock
+    :return: whether the job ran, the seconds waited for the lock and the result of the job. errors of the job propagate
+    """
+    start = time.monotonic()
+    with suppress(LockNotGranted), exclusive_run_ctx(oid, mode, key, timeout, wait) as run:
+        return RunReport(True, run.waited, job(*args, **(kwargs or {})))
+    return RunReport(False, time.monotonic() - start, None)
+
+
+def runs_exclusive(oid: Space,
+                   mode: LockMode = LockMode.SESSION,
+                   key: Optional[Union[int, Callable[..., int]]] = None,
+                   timeout: Optional[float] = None,
+                   wait: WaitMode = WaitMode.BACKOFF) -> Callable[[Callable], Callable[..., _RT]]:
+    # pylint: disable=too-many-arguments
     """
-    decorator to run a function insided an exclusive run within the space specified
+    decorator to run a function insided an exclusive run within the space specified, the call returns `None` if the
+    lock is taken
     :param oid: the space to run in
+    :param mode: how the lock is held, see `exclusive_run_ctx`
+    :param key: optional key within the space, either fixed or a function called with the arguments of each call,
+                e.g. `key=lambda source_id, **_: source_id`
+    :param timeout: seconds to wait for a taken lock, see `exclusive_run_ctx`
+    :param wait: how to wait for a taken lock
     """
 
     def wrapper(fun: Callable[..., _RT]) -> Callable[..., _RT]:
         # pylint: disable=missing-docstring
         @wraps(fun)
         def wrapped(*args: Any, **kwargs: Any) -> _RT:
-            return run_exclusive_job(oid, fun, *args, **kwargs)
+            run_key = key(*args, **kwargs) if callable(key) else key
+            with suppress(LockNotGranted), exclusive_run_ctx(oid, mode, run_key, timeout, wait):
+                return fun(*args, **kwargs)
 
         return wrapped
 
@@ -0,0 +1,126 @@
+"""
+asyncio counterparts of the exclusive runs of `common.job`, based on the shared engines of `common.db.aio`. The
+advisory lock is taken on a pooled connection, so it has to be released explicitly before the connection returns to
+the pool. Releasing is shielded from cancellation, if it fails the connection is invalidated, closing it server side
+releases the lock as well.
+"""
+import asyncio
+import logging
+import uuid
+from collections import namedtuple
+from contextlib import asynccontextmanager, suppress
+from functools import wraps
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, TypeVar, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from . import _FINISH_JOB_SQL, _LOCK_FUNCTIONS, LockMode, LockNotGranted, Outcome, Space, _check_key, _lock_expression
+from ..db import DEFAULT_ENGINE
+from ..db.aio import get_async_engine
+
+# asyncpg can't infer the type of an untyped `NULL` parameter, hence the casts and no optional start timestamp
+_START_JOB_ASYNC_SQL = '''
+INSERT INTO activity.job(owner, pid, oid, key, granted, timestamp, comment)
+SELECT CURRENT_USER, pg_backend_pid(), CAST(:oid AS BIGINT), CAST(:key AS INTEGER), %(lock)s, now(),
+       CAST(:comment AS VARCHAR)
+RETURNING id, granted
+'''
+
+_START_JOB_ASYNC_SQLS = dict(
+    (keyed, text(_START_JOB_ASYNC_SQL % dict(lock=_lock_expression(_LOCK_FUNCTIONS[LockMode.SESSION], keyed))))
+    for keyed in (False, True))
+
+_UNLOCK_ALL_SQL = text('SELECT pg_advisory_unlock_all()')
+
+AsyncRun = namedtuple('AsyncRun', ['id', 'connection', 'session'])
+
+
+async def _release(connection: AsyncConnection,
+                   session: AsyncSession,
+                   job_id: Optional[int],
+                   error: Optional[BaseException]) -> None:
+    """finish the job row and release the lock, the connection is invalidated if that fails"""
+    try:
+        await session.close()
+        await connection.rollback()
+        if job_id is not None:
+            await connection.execute(_FINISH_JOB_SQL, dict(
+                ids=[job_id], outcome=(Outcome.FAILURE if error is not None else Outcome.SUCCESS).value,
+                error=repr(error) if error is not None else None))
+        await connection.execute(_UNLOCK_ALL_SQL)
+        await connection.commit()
+    except BaseException:  # pylint: disable=broad-except
+        logging.exception('Couldn\'t release exclusive run, invalidating the connection')
+        await connection.invalidate()
+    finally:
+        await connection.close()
+
+
+@asynccontextmanager
+async def exclusive_run_ctx_async(oid: Space,
+                                  key: Optional[int] = None,
+                                  comment: Optional[str] = None,
+                                  name: str = DEFAULT_ENGINE) -> AsyncGenerator[AsyncRun, None]:
+    """
+    asyncio exclusive context within the space specified, like `exclusive_run_ctx` the context is skipped by raising
+    `LockNotGranted` if the lock is taken. the lock is released even if the enclosing task is cancelled.
+    :param oid: the space to run in
+    :param key: optional 4 byte integer to lock only `key` within the space
+    :param comment: stored with the job row
+    :param name: the name of the engine to use, see `get_async_engine`
+    """
+    _check_key(key)
+    run_id = uuid.uuid1()
+    connection = await get_async_engine(name).connect()
+    session = AsyncSession(bind=connection, expire_on_commit=False)
+    job_id = None  # type: Optional[int]
+    error = None  # type: Optional[BaseException]
+    try:
+        logging.debug('Starting async exclusive job for oid: %d, key: %s, run: %s', oid.value, key, run_id)
+        job_id, granted = (await connection.execute(_START_JOB_ASYNC_SQLS[key is not None],
+                                                    dict(oid=oid.value, key=key, comment=comment))).one()
+        await connection.commit()
+        if not granted:
+            job_id = None
+            raise LockNotGranted('couldn\'t grant job for oid: %d, key: %s' % (oid.value, key))
+        yield AsyncRun(run_id, connection, session)
+    except BaseException as err:
+        if job_id is None:
+            logging.debug('Couldn\'t fetch lock for oid: %d, key: %s, run: %s', oid.value, key, run_id)
+        error = err
+        raise
+    finally:
+        await asyncio.shield(_release(connection, session, job_id, error))
+        logging.debug('Done with async exclusive job for oid: %d, key: %s, run: %s', oid.value, key, run_id)
+
+
+_RT = TypeVar('_RT')
+
+
+def runs_exclusive_async(oid: Space,
+                         key: Optional[Union[int, Callable[..., int]]] = None,
+                         name: str = DEFAULT_ENGINE) -> Callable[[Callable[..., Awaitable[_RT]]],
+                                                                 Callable[..., Awaitable[Optional[_RT]]]]:
+    """
+    decorator to run a coroutine function inside an asyncio exclusive run within the space specified, the coroutine
+    is skipped and `None` returned if the lock is taken
+    :param oid: the space to run in
+    :param key: optional key within the space, either fixed or a function called with the arguments of each call,
+                see `runs_exclusive`
+    :param name: the name of the engine to use
+    """
+
+    def wrapper(fun: Callable[..., Awaitable[_RT]]) -> Callable[..., Awaitable[Optional[_RT]]]:
+        # pylint: disable=missing-docstring
+        @wraps(fun)
+        async def wrapped(*args: Any, **kwargs: Any) -> Optional[_RT]:
+            run_key = key(*args, **kwargs) if callable(key) else key
+            with suppress(LockNotGranted):
+                async with exclusive_run_ctx_async(oid, run_key, name=name):
+                    return await fun(*args, **kwargs)
+            return None
+
+        return wrapped
+
+    return wrapper
@@ -0,0 +1,76 @@
+"""
+Statistics over and retention of the `activity.job` rows written by exclusive runs. Partitioning the table by time was
+considered, at the current volume batched deletes keep it bounded without changing its primary key.
+"""
+import datetime
+from collections import namedtuple
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import Outcome, Space
+
+JobStats = namedtuple('JobStats', ['space', 'runs', 'succeeded', 'failed', 'skipped', 'p50', 'p95', 'total'])
+
+_STATS_SQL = text('''
+WITH runs AS (
+    SELECT oid, granted, outcome, extract(EPOCH FROM finished - timestamp) AS duration FROM activity.job
+    WHERE timestamp >= :since AND timestamp < :until
+)
+SELECT oid,
+       count(*) FILTER (WHERE granted),
+       count(*) FILTER (WHERE outcome = :success),
+       count(*) FILTER (WHERE outcome = :failure),
+       count(*) FILTER (WHERE NOT granted),
+       percentile_cont(0.5) WITHIN GROUP (ORDER BY duration) FILTER (WHERE duration IS NOT NULL),
+       percentile_cont(0.95) WITHIN GROUP (ORDER BY duration) FILTER (WHERE duration IS NOT NULL),
+       coalesce(sum(duration), 0)
+FROM runs
+GROUP BY oid
+ORDER BY oid
+''')
+
+_PRUNE_SQL = text('''
+DELETE FROM activity.job WHERE id IN (
+    SELECT id FROM activity.job WHERE timestamp < :before LIMIT :limit
+)
+''')
+
+
+def job_stats(session: Session,
+              since: datetime.datetime,
+              until: Optional[datetime.datetime] = None) -> List[JobStats]:
+    """
+    Per space statistics of the runs started within a time window, e.g. to find the spaces hogging capacity.
+    :param session: the session to query with
+    :param since: start of the window
+    :param until: end of the window, defaults to now
+    :return: per space the number of granted, succeeded, failed and skipped runs, the median and 95th percentile run
+             time and the total run time, all in seconds. `space` is the raw oid if it isn't a known `Space`.
+    """
+    until = until or datetime.datetime.now(datetime.timezone.utc)
+    rows = session.execute(_STATS_SQL, params=dict(since=since, until=until, success=Outcome.SUCCESS.value,
+                                                   failure=Outcome.FAILURE.value))
+    known = set(space.value for space in Space)
+    return [JobStats(Space(row[0]) if row[0] in known else row[0], *row[1:]) for row in rows]
+
+
+def prune_jobs(session: Session, older_than: datetime.timedelta = datetime.timedelta(days=30),
+               batch_size: int = 10000) -> int:
+    """
+    Delete job rows started before the retention period, in batches that are committed one by one to keep locks short.
+    Meant to run periodically, e.g. `run_exclusive_job(Space.WORKER, prune_jobs, session)`.
+    :param session: the session to delete with, it is committed after every batch
+    :param older_than: the retention period
+    :param batch_size: maximum rows deleted per transaction
+    :return: the number of deleted rows
+    """
+    before = datetime.datetime.now(datetime.timezone.utc) - older_than
+    deleted = 0
+    while True:
+        count = session.execute(_PRUNE_SQL, params=dict(before=before, limit=batch_size)).rowcount
+        session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
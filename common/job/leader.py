@@ -0,0 +1,206 @@
+"""
+Lease based leader election for long running services. A leader holds a row in `activity.lease` that expires after
+`ttl` seconds and renews it from a background heartbeat thread. Unlike a session advisory lock the leadership doesn't
+depend on a single long lived connection: if renewing fails the leader steps down once its lease ran out locally, and a
+standby takes over as soon as the lease expired in the database, i.e. within `ttl` plus one renew interval.
+
+Stepping down is done by a watchdog timer armed at the local expiry of the lease, a renewal hanging on a silently dead
+connection can't delay it. Renewals use a dedicated engine with client side connect and TCP timeouts, so such a
+renewal fails within about one renew interval instead of waiting for the system TCP timeouts.
+"""
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from ..db import DEFAULT_ENGINE, default_engine
+
+_ACQUIRE_SQL = text('''
+INSERT INTO activity.lease(name, holder, acquired_at, expires_at)
+VALUES (:name, :holder, now(), now() + :ttl * INTERVAL '1 second')
+ON CONFLICT (name) DO UPDATE SET
+    holder = EXCLUDED.holder,
+    acquired_at = CASE WHEN lease.holder = EXCLUDED.holder THEN lease.acquired_at ELSE EXCLUDED.acquired_at END,
+    expires_at = EXCLUDED.expires_at
+WHERE lease.holder = EXCLUDED.holder OR lease.expires_at < now()
+RETURNING holder
+''')
+
+_RELEASE_SQL = text('DELETE FROM activity.lease WHERE name = :name AND holder = :holder')
+
+_STATEMENT_TIMEOUT_SQL = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+def _connect_args(timeout: float) -> Dict[str, int]:
+    """:return: libpq parameters failing connects and requests to an unresponsive server after about `timeout`"""
+    return dict(connect_timeout=max(2, int(math.ceil(timeout))),  # libpq treats values below 2 as 2
+                keepalives=1,
+                keepalives_idle=max(1, int(timeout / 2)),
+                keepalives_interval=1,
+                keepalives_count=max(1, int(math.ceil(timeout / 2))),
+                tcp_user_timeout=max(1, int(timeout * 1000)))
+
+
+def default_holder() -> str:
+    """:return: an identifier unique to this process, e.g. `host:1234:0f3a9c1e`"""
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaderElection:
+    # pylint: disable=too-many-instance-attributes
+    """
+    Campaigns for the lease `name` in a background thread, use as context manager or via `start` and `stop`.
+    the callbacks are called from the heartbeat thread, they should return quickly.
+    """
+
+    def __init__(self,
+                 name: str,
+                 ttl: float = 15.0,
+                 renew_interval: Optional[float] = None,
+                 on_elected: Optional[Callable[[], Any]] = None,
+                 on_lost: Optional[Callable[[], Any]] = None,
+                 holder: Optional[str] = None,
+                 engine: str = DEFAULT_ENGINE) -> None:
+        # pylint: disable=too-many-arguments
+        """
+        :param name: the name of the lease, e.g. `'brain-trainer'`
+        :param ttl: seconds a lease stays valid without renewal, bounds the failover time
+        :param renew_interval: seconds between renewals (and between attempts of standbys), defaults to a third of `ttl`
+        :param on_elected: called when this process becomes the leader
+        :param on_lost: called when this process stops being the leader, including on `stop`
+        :param holder: identifies this process, see `default_holder`
+        :param engine: the config section of the database, a dedicated engine with client side timeouts is created
+        """
+        assert ttl > 0, "ttl must be positive"
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval if renew_interval is not None else ttl / 3
+        assert self.renew_interval < ttl, "the lease has to be renewed before it expires"
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.holder = holder or default_holder()
+        self.engine = engine
+        self._leader = False
+        self._valid_until = 0.0
+        self._lock = threading.RLock()
+        self._watchdog = None  # type: Optional[threading.Timer]
+        self._engine = None  # type: Optional[Engine]
+        self._elected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def is_leader(self) -> bool:
+        """:return: whether this process holds a lease that didn't run out locally"""
+        return self._leader and time.monotonic() < self._valid_until
+
+    def wait_elected(self, timeout: Optional[float] = None) -> bool:
+        """:return: whether this process became the leader within `timeout` seconds"""
+        return self._elected.wait(timeout) and self.is_leader
+
+    def _execute(self, statement: Any, **params: Any) -> Any:
+        if self._engine is None:
+            self._engine = default_engine(self.engine, pool_size=1, max_overflow=0,
+                                          connect_args=_connect_args(self.renew_interval))
+        with self._engine.begin() as connection:
+            # the client side timeouts cover a dead connection, this one a renewal hanging within the server
+            connection.execute(_STATEMENT_TIMEOUT_SQL, timeout='%dms' % max(1, int(self.renew_interval * 1000)))
+            result = connection.execute(statement, **params)
+            return result.fetchall() if result.returns_rows else None
+
+    def _set_leader(self, leader: bool) -> None:
+        with self._lock:
+            if leader == self._leader:
+                return
+            self._leader = leader
+            callback = self.on_elected if leader else self.on_lost
+            if leader:
+                self._elected.set()
+            else:
+                self._elected.clear()
+                self._disarm()
+            logging.info('%s %s lease %s', self.holder, 'acquired' if leader else 'lost', self.name)
+            if callback is not None:
+                try:
+                    callback()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('leader callback of lease %s failed', self.name)
+
+    def _disarm(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _renewed(self, valid_until: float) -> None:
+        """extend the local lease and rearm the watchdog stepping down once it runs out"""
+        with self._lock:
+            self._valid_until = valid_until
+            self._disarm()
+            self._watchdog = threading.Timer(max(0.0, valid_until - time.monotonic()), self._expire)
+            self._watchdog.name = 'lease-%s-watchdog' % self.name
+            self._watchdog.daemon = True
+            self._watchdog.start()
+            self._set_leader(True)
+
+    def _expire(self) -> None:
+        with self._lock:
+            if time.monotonic() >= self._valid_until:
+                logging.warning('lease %s ran out before it was renewed', self.name)
+                self._set_leader(False)
+
+    def _heartbeat(self) -> None:
+        """try to acquire or renew the lease once"""
+        started = time.monotonic()
+        try:
+            acquired = bool(self._execute(_ACQUIRE_SQL, name=self.name, holder=self.holder, ttl=self.ttl))
+        except SQLAlchemyError:
+            logging.exception('renewing lease %s failed', self.name)
+            acquired = None
+        if acquired:
+            self._renewed(started + self.ttl)
+        elif acquired is False:
+            self._set_leader(False)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._heartbeat()
+            self._stopped.wait(self.renew_interval)
+
+    def start(self) -> 'LeaderElection':
+        """start campaigning in a daemon thread"""
+        assert self._thread is None, "the election is already running"
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='lease-%s' % self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """stop campaigning and hand over the lease right away if held"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self._leader:
+            try:
+                self._execute(_RELEASE_SQL, name=self.name, holder=self.holder)
+            except SQLAlchemyError:
+                logging.exception('releasing lease %s failed, it expires within %.1fs', self.name, self.ttl)
+            self._set_leader(False)
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+
+    def __enter__(self) -> 'LeaderElection':
+        return self.start()
+
+    def __exit__(self, *_: Any) -> None:
+        self.stop()
@@ -0,0 +1,244 @@
+"""
+Postgres backed task queue. Tasks are claimed with `FOR UPDATE SKIP LOCKED`, so any number of workers can dequeue
+concurrently without blocking each other. A claimed task becomes invisible for a visibility timeout, if it's neither
+acknowledged nor rejected within that time it's handed out again, until `max_attempts` is reached. Enqueueing notifies
+waiting workers via `LISTEN`/`NOTIFY`, polling is only a fallback.
+"""
+import json
+import logging
+import select
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from ..db import DEFAULT_ENGINE, get_engine, get_session
+from ..db.models.job import Task
+
+CHANNEL = 'activity_task'
+
+ERROR_BACKOFF_INITIAL = 1.0
+ERROR_BACKOFF_MAX = 60.0
+
+_ENQUEUE_SQL = text('''
+INSERT INTO activity.task(queue, payload, priority, max_attempts, available_at)
+SELECT :queue, CAST(payload AS JSONB), :priority, :max_attempts, now() + :delay * INTERVAL '1 second'
+FROM unnest(CAST(:payloads AS TEXT[])) AS payload
+RETURNING id
+''')
+
+_NOTIFY_SQL = text('SELECT pg_notify(:channel, :queue)')
+
+_DEQUEUE_SQL = text('''
+UPDATE activity.task SET attempts = attempts + 1, available_at = now() + :timeout * INTERVAL '1 second'
+WHERE id IN (
+    SELECT id FROM activity.task
+    WHERE queue = :queue AND available_at <= now() AND attempts < max_attempts
+    ORDER BY priority DESC, available_at, id
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, queue, payload, priority, attempts, max_attempts, available_at, created_at, error
+''')
+
+_ACK_SQL = text('DELETE FROM activity.task WHERE id = ANY(:ids)')
+
+_NACK_SQL = text('''
+UPDATE activity.task SET available_at = now() + :delay * INTERVAL '1 second', error = :error
+WHERE id = ANY(:ids)
+''')
+
+_DEAD_SQL = text('''
+SELECT id, queue, payload, priority, attempts, max_attempts, available_at, created_at, error FROM activity.task
+WHERE queue = :queue AND attempts >= max_attempts
+ORDER BY id
+''')
+
+
+def _tasks(rows: Iterable[Any]) -> List[Task]:
+    return [Task(**dict(row.items())) for row in rows]
+
+
+def enqueue(session: Session,
+            queue: str,
+            payloads: Iterable[Dict[str, Any]],
+            priority: int = 0,
+            delay: float = 0,
+            max_attempts: int = 5) -> List[int]:
+    # pylint: disable=too-many-arguments
+    """
+    Add tasks to a queue. waiting workers are notified once the session commits.
+    :param session: the session to enqueue in, the caller commits
+    :param queue: the name of the queue, e.g. `'crawl'`
+    :param payloads: json serializable payloads, one task per payload
+    :param priority: higher priorities are dequeued first
+    :param delay: seconds until the tasks become visible
+    :param max_attempts: how often a task is handed out before it's considered dead
+    :return: the ids of the new tasks
+    """
+    encoded = [json.dumps(payload) for payload in payloads]
+    if not encoded:
+        return []
+    ids = [row.id for row in session.execute(_ENQUEUE_SQL, params=dict(
+        queue=queue, payloads=encoded, priority=priority, delay=delay, max_attempts=max_attempts))]
+    session.execute(_NOTIFY_SQL, params=dict(channel=CHANNEL, queue=queue))
+    return ids
+
+
+def dequeue(session: Session, queue: str, limit: int = 1, visibility_timeout: float = 300) -> List[Task]:
+    """
+    Claim up to `limit` visible tasks, highest priority first. Commit right after, the claimed tasks stay invisible for
+    `visibility_timeout` seconds without holding any row locks.
+    :param session: the session to dequeue in, the caller commits
+    :param queue: the name of the queue
+    :param limit: maximum number of tasks claimed
+    :param visibility_timeout: seconds until an unacknowledged task is handed out again
+    :return: the claimed tasks (detached), possibly none
+    """
+    return _tasks(session.execute(_DEQUEUE_SQL, params=dict(queue=queue, limit=limit, timeout=visibility_timeout)))
+
+
+def ack(session: Session, ids: Sequence[int]) -> int:
+    """
+    Mark tasks as done by deleting them.
+    :param session: the session to acknowledge in, the caller commits
+    :param ids: the ids of the finished tasks
+    :return: the number of deleted tasks
+    """
+    return session.execute(_ACK_SQL, params=dict(ids=list(ids))).rowcount if ids else 0
+
+
+def nack(session: Session, ids: Sequence[int], error: Optional[str] = None, delay: float = 0) -> int:
+    """
+    Hand tasks back to the queue, e.g. after a failure. Tasks that used up their attempts remain dead, see `dead_tasks`.
+    :param session: the session to reject in, the caller commits
+    :param ids: the ids of the rejected tasks
+    :param error: optional error message stored with the tasks
+    :param delay: seconds until the tasks become visible again
+    :return: the number of rejected tasks
+    """
+    return session.execute(_NACK_SQL, params=dict(ids=list(ids), error=error, delay=delay)).rowcount if ids else 0
+
+
+def dead_tasks(session: Session, queue: str) -> List[Task]:
+    """:return: the tasks of `queue` that used up all their attempts"""
+    return _tasks(session.execute(_DEAD_SQL, params=dict(queue=queue)))
+
+
+class Listener:
+    """Waits for enqueue notifications on a dedicated connection, use as context manager."""
+
+    def __init__(self, name: str = DEFAULT_ENGINE) -> None:
+        """:param name: the name of the engine to use, see `get_engine`"""
+        self._name = name
+        self._connection = None  # type: Any
+
+    def __enter__(self) -> 'Listener':
+        self._connection = get_engine(self._name).raw_connection()
+        self._connection.connection.autocommit = True
+        with self._connection.cursor() as cursor:
+            cursor.execute('LISTEN %s' % CHANNEL)
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        try:
+            with self._connection.cursor() as cursor:
+                cursor.execute('UNLISTEN %s' % CHANNEL)
+            self._connection.connection.autocommit = False
+        except Exception:  # pylint: disable=broad-except
+            # e.g. the connection was lost, don't return it to the pool
+            logging.warning('couldn\'t unlisten, invalidating the connection', exc_info=True)
+            self._connection.invalidate()
+        finally:
+            self._connection.close()
+            self._connection = None
+
+    def wait(self, queue: str, timeout: float) -> bool:
+        """
+        :param queue: the queue to wait for
+        :param timeout: maximum seconds to wait
+        :return: whether tasks were enqueued into `queue` in the meantime
+        """
+        connection = self._connection.connection
+        deadline = time.monotonic() + timeout
+        while True:
+            connection.poll()
+            notified = any(notify.payload == queue for notify in connection.notifies)
+            del connection.notifies[:]
+            remaining = deadline - time.monotonic()
+            if notified or remaining <= 0:
+                return notified
+            select.select([connection], [], [], remaining)
+
+
+class Worker:
+    """Consumes a queue, acknowledging tasks the handler processed and rejecting those it raised for."""
+
+    def __init__(self,
+                 queue: str,
+                 handler: Callable[[Task], Any],
+                 batch_size: int = 10,
+                 visibility_timeout: float = 300,
+                 retry_delay: float = 60,
+                 poll_interval: float = 30,
+                 name: str = DEFAULT_ENGINE) -> None:
+        # pylint: disable=too-many-arguments
+        """
+        :param queue: the name of the queue
+        :param handler: called with every claimed task
+        :param batch_size: maximum number of tasks claimed at once
+        :param visibility_timeout: seconds a batch may take before its tasks are handed out again
+        :param retry_delay: seconds until a failed task becomes visible again
+        :param poll_interval: maximum seconds between two dequeues if no notification arrives
+        :param name: the name of the engine to use, see `get_engine`
+        """
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.name = name
+        self.stopped = threading.Event()
+
+    def run_once(self) -> int:
+        """:return: the number of tasks processed by a single dequeue, 0 if dequeueing failed"""
+        tasks = []  # type: List[Task]
+        with get_session(self.name) as session:  # logs and rolls back database errors
+            tasks = dequeue(session, self.queue, self.batch_size, self.visibility_timeout)
+            session.commit()
+            done = []  # type: List[int]
+            for task in tasks:
+                try:
+                    self.handler(task)
+                    done.append(task.id)
+                except Exception as err:  # pylint: disable=broad-except
+                    logging.exception('task %d of queue %s failed', task.id, self.queue)
+                    nack(session, [task.id], error=repr(err), delay=self.retry_delay)
+            ack(session, done)
+            session.commit()
+        return len(tasks)
+
+    def run(self) -> None:
+        """
+        process tasks until `stop` is called, sleeping until notified whenever the queue is empty. database errors,
+        e.g. a lost connection or a failover, are logged and retried with exponential backoff
+        """
+        delay = ERROR_BACKOFF_INITIAL
+        while not self.stopped.is_set():
+            try:
+                with Listener(self.name) as listener:
+                    while not self.stopped.is_set():
+                        if not self.run_once() and not self.stopped.is_set():
+                            listener.wait(self.queue, self.poll_interval)
+                        delay = ERROR_BACKOFF_INITIAL
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('worker of queue %s failed, retrying in %.1fs', self.queue, delay)
+                self.stopped.wait(delay)
+                delay = min(delay * 2, ERROR_BACKOFF_MAX)
+
+    def stop(self) -> None:
+        """stop after the current batch, a waiting worker notices within `poll_interval`"""
+        self.stopped.set()
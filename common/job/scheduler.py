@@ -0,0 +1,323 @@
+"""
+Distributed scheduler for periodic jobs. Every node registers the same jobs, a tick of a job is claimed by the first
+node taking the keyed advisory lock of the job and recording the tick in `activity.job`, so each tick runs at most once
+across all nodes. Ticks are aligned to the epoch (intervals) or the wall clock (cron expressions, in UTC), hence all
+nodes agree on them. Ticks missed while no node was running are caught up, a per node jitter spreads the claims.
+"""
+import datetime
+import logging
+import random
+import threading
+import zlib
+from collections import deque, namedtuple
+from contextlib import suppress
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Union
+
+from sqlalchemy import text
+
+from . import MIN_KEY, LockNotGranted, Space, exclusive_run_ctx
+from ..db import get_session
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MAX_CATCH_UP_SCAN = 10000
+
+RETRY_INTERVAL = datetime.timedelta(seconds=10)
+
+_CLAIMED_SQL = text('''
+SELECT count(*) FROM activity.job WHERE oid = :oid AND key = :key AND comment = :comment AND granted
+''')
+
+_LAST_TICK_SQL = text('''
+SELECT comment FROM activity.job WHERE oid = :oid AND key = :key AND granted ORDER BY id DESC LIMIT 1
+''')
+
+Tick = namedtuple('Tick', ['name', 'tick', 'ran'])
+
+
+class Interval:
+    """Ticks every `period`, aligned to the epoch"""
+
+    def __init__(self, period: Union[float, datetime.timedelta]) -> None:
+        """:param period: seconds or timedelta between two ticks"""
+        self.period = period if isinstance(period, datetime.timedelta) else datetime.timedelta(seconds=period)
+        assert self.period > datetime.timedelta(0), "the period must be positive"
+
+    def next(self, after: datetime.datetime) -> datetime.datetime:
+        """:return: the first tick after `after`"""
+        return after + self.period - (after - _EPOCH) % self.period
+
+    def __repr__(self) -> str:
+        return 'Interval(%r)' % self.period
+
+
+class CronExpression:
+    """
+    Minimal cron expression: `minute hour day-of-month month day-of-week`, each a `*`, a number, a range `a-b` or a
+    list of them, optionally with a step `/n`. days of week count from 0 (sunday) to 6. like cron, if both days are
+    restricted a day matching either of them matches.
+    """
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression: str) -> None:
+        """:param expression: e.g. `'*/15 * * * *'` or `'0 3 * * 1-5'`"""
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('invalid cron expression, expected 5 fields: %s' % expression)
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self._RANGES)]
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> Set[int]:
+        values = set()  # type: Set[int]
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            try:
+                if span == '*':
+                    start, stop = low, high
+                elif '-' in span:
+                    start, stop = (int(value) for value in span.split('-', 1))
+                else:
+                    start = stop = int(span)
+                    if step:
+                        stop = high
+                increment = int(step) if step else 1
+            except ValueError as err:
+                raise ValueError('invalid cron field: %s' % field) from err
+            if not low <= start <= stop <= high or increment < 1:
+                raise ValueError('invalid cron field: %s' % field)
+            values.update(range(start, stop + 1, increment))
+        return values
+
+    def _day_matches(self, day: datetime.datetime) -> bool:
+        in_days = day.day in self.days
+        in_weekdays = (day.isoweekday() % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next(self, after: datetime.datetime) -> datetime.datetime:
+        """:return: the first matching minute after `after`"""
+        current = after.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0) + datetime.timedelta(
+            minutes=1)
+        limit = current + datetime.timedelta(days=366 * 5)
+        while current < limit:
+            if current.month not in self.months:
+                current = (current.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(current):
+                current = current.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif current.hour not in self.hours:
+                current = current.replace(minute=0) + datetime.timedelta(hours=1)
+            elif current.minute not in self.minutes:
+                current += datetime.timedelta(minutes=1)
+            else:
+                return current
+        raise ValueError('cron expression never matches: %s' % self.expression)
+
+    def __repr__(self) -> str:
+        return 'CronExpression(%r)' % self.expression
+
+
+class ScheduledJob:
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """A job registered with a `Scheduler`"""
+
+    def __init__(self,
+                 name: str,
+                 schedule: Union[Interval, CronExpression],
+                 job: Callable[[datetime.datetime], Any],
+                 oid: Space,
+                 catch_up: int,
+                 jitter: float) -> None:
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.schedule = schedule
+        self.job = job
+        self.oid = oid
+        self.catch_up = catch_up
+        self.jitter = jitter
+        self.key = zlib.crc32(name.encode('utf-8')) + MIN_KEY
+        self.pending = deque()  # type: Deque[datetime.datetime]
+        self.due = None  # type: Optional[datetime.datetime]
+
+    def comment(self, tick: datetime.datetime) -> str:
+        """:return: the comment recording `tick` in `activity.job`"""
+        return '%s@%s' % (self.name, tick.isoformat())
+
+    def _plan(self, tick: datetime.datetime) -> None:
+        self.pending.append(tick)
+        self.due = tick + datetime.timedelta(seconds=random.uniform(0, self.jitter))
+
+    def _missed(self, now: datetime.datetime, last: datetime.datetime) -> List[datetime.datetime]:
+        """:return: the latest `catch_up` ticks after `last` up to `now`, scanned in windows growing back from `now`"""
+        window = max(self.schedule.next(now) - now, datetime.timedelta(minutes=1)) * self.catch_up
+        while True:
+            start = max(last, now - window)
+            missed = deque(maxlen=self.catch_up)  # type: Deque[datetime.datetime]
+            tick = start
+            for _ in range(_MAX_CATCH_UP_SCAN):
+                tick = self.schedule.next(tick)
+                if tick > now:
+                    break
+                missed.append(tick)
+            else:
+                logging.warning('more than %d ticks of %s since %s, skipping the missed ones', _MAX_CATCH_UP_SCAN,
+                                self.name, start)
+                return []
+            if len(missed) == self.catch_up or start == last:
+                return list(missed)
+            window *= 2
+
+    def start(self, now: datetime.datetime, last: Optional[datetime.datetime]) -> None:
+        """plan the ticks missed since `last`, but at most the latest `catch_up`, followed by the next regular tick"""
+        self.pending.clear()
+        if last is not None and self.catch_up:
+            self.pending.extend(self._missed(now, last))
+        if self.pending:
+            self.due = now
+        else:
+            self._plan(self.schedule.next(now))
+
+    def advance(self, now: datetime.datetime) -> datetime.datetime:
+        """:return: the tick to claim next, the following one is planned once the pending ticks are used up"""
+        tick = self.pending.popleft()
+        if not self.pending:
+            self._plan(self.schedule.next(max(tick, now)))
+        return tick
+
+
+def _schedule(schedule: Union[str, float, datetime.timedelta, Interval, CronExpression]) -> Any:
+    if isinstance(schedule, (Interval, CronExpression)):
+        return schedule
+    return CronExpression(schedule) if isinstance(schedule, str) else Interval(schedule)
+
+
+class Scheduler:
+    """Runs registered jobs on their ticks, see the module docstring. Jobs run one after another in `run`."""
+
+    def __init__(self, oid: Space = Space.WORKER) -> None:
+        """:param oid: the default space of the jobs"""
+        self.oid = oid
+        self.jobs = {}  # type: Dict[str, ScheduledJob]
+        self._started = False
+        self._stopped = threading.Event()
+
+    def register(self,
+                 name: str,
+                 schedule: Union[str, float, datetime.timedelta, Interval, CronExpression],
+                 job: Callable[[datetime.datetime], Any],
+                 oid: Optional[Space] = None,
+                 catch_up: int = 1,
+                 jitter: float = 0.0) -> ScheduledJob:
+        # pylint: disable=too-many-arguments
+        """
+        :param name: unique name of the job, has to be the same on all nodes
+        :param schedule: a cron expression, or the seconds or timedelta between two ticks
+        :param job: called with the tick it runs for
+        :param oid: the space to run in, defaults to the one of the scheduler
+        :param catch_up: maximum number of missed ticks run on start, the latest ones. 0 skips missed ticks
+        :param jitter: maximum seconds a claim is delayed after its tick, randomly per node
+        :return: the registered job
+        """
+        assert name not in self.jobs, "job %s already registered" % name
+        scheduled = self.jobs[name] = ScheduledJob(name, _schedule(schedule), job, oid or self.oid, catch_up, jitter)
+        if self._started:
+            self._start(scheduled, datetime.datetime.now(datetime.timezone.utc))
+        return scheduled
+
+    def scheduled(self, name: str, schedule: Union[str, float, datetime.timedelta], **kwargs: Any) -> Callable:
+        """decorator variant of `register`"""
+
+        def wrapper(fun: Callable[[datetime.datetime], Any]) -> Callable[[datetime.datetime], Any]:
+            self.register(name, schedule, fun, **kwargs)
+            return fun
+
+        return wrapper
+
+    @staticmethod
+    def _last_tick(scheduled: ScheduledJob) -> Optional[datetime.datetime]:
+        """:return: the latest tick of the job claimed by any node"""
+        with get_session() as session:
+            comment = session.execute(_LAST_TICK_SQL, params=dict(oid=scheduled.oid.value, key=scheduled.key)).scalar()
+            if comment and comment.startswith(scheduled.name + '@'):
+                with suppress(ValueError):
+                    return datetime.datetime.fromisoformat(comment[len(scheduled.name) + 1:])
+        return None
+
+    def _start(self, scheduled: ScheduledJob, now: datetime.datetime) -> None:
+        scheduled.start(now, self._last_tick(scheduled))
+
+    def _claim(self, scheduled: ScheduledJob, tick: datetime.datetime) -> bool:
+        """
+        :return: whether this node claimed and ran the tick. errors of the job are logged, errors before it started,
+                 e.g. failing to connect, propagate
+        """
+        comment = scheduled.comment(tick)
+        failure = None  # type: Optional[Exception]
+        try:
+            with suppress(LockNotGranted), exclusive_run_ctx(scheduled.oid, key=scheduled.key,
+                                                             comment=comment) as run:
+                # our own job row is committed already, any other granted one means the tick was claimed before
+                claimed = run.session.execute(_CLAIMED_SQL, params=dict(oid=scheduled.oid.value, key=scheduled.key,
+                                                                        comment=comment)).scalar()
+                if claimed > 1:
+                    return False
+                try:
+                    scheduled.job(tick)
+                except Exception as err:
+                    failure = err
+                    raise
+                return True
+            return False
+        except Exception:  # pylint: disable=broad-except
+            if failure is None:
+                raise
+            logging.exception('scheduled job %s failed for tick %s', scheduled.name, tick)
+            return True
+
+    def run_pending(self, now: Optional[datetime.datetime] = None) -> List[Tick]:
+        """
+        claim and run all due ticks once
+        :param now: the current time, timezone aware
+        :return: the due ticks and whether they ran on this node
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        if not self._started:
+            for scheduled in self.jobs.values():
+                self._start(scheduled, now)
+            self._started = True
+        ticks = []  # type: List[Tick]
+        for scheduled in self.jobs.values():
+            while scheduled.due is not None and scheduled.due <= now and scheduled.pending:
+                tick = scheduled.pending[0]
+                try:
+                    ran = self._claim(scheduled, tick)
+                except Exception:  # pylint: disable=broad-except
+                    # the job didn't start, keep the tick. a retry after the tick row was committed sees it claimed
+                    logging.exception('claiming tick %s of %s failed, retrying in %s', tick, scheduled.name,
+                                      RETRY_INTERVAL)
+                    scheduled.due = now + RETRY_INTERVAL
+                    break
+                scheduled.advance(now)
+                logging.debug('tick %s of %s %s', tick, scheduled.name, 'ran' if ran else 'was claimed elsewhere')
+                ticks.append(Tick(scheduled.name, tick, ran))
+        return ticks
+
+    def run(self, max_sleep: float = 60.0) -> None:
+        """
+        run due ticks until `stop` is called
+        :param max_sleep: upper bound of the seconds slept between two checks
+        """
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            self.run_pending()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            dues = [scheduled.due for scheduled in self.jobs.values() if scheduled.due is not None]
+            sleep = min([(due - now).total_seconds() for due in dues] + [max_sleep])
+            self._stopped.wait(max(0.0, sleep))
+
+    def stop(self) -> None:
+        """stop `run` after the current job"""
+        self._stopped.set()
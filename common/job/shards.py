@@ -0,0 +1,133 @@
+"""
+Sharded exclusive runs, e.g. for backfills over `activity.data`. An id range is split into shards which run in a
+`ProcessPoolExecutor`, each inside its own keyed exclusive run. Several nodes can run the same sharded job, every shard
+is processed once. Shards are recorded in `activity.job` by their comment, successfully finished shards are skipped
+when the job is restarted.
+"""
+import logging
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import suppress
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+
+from . import MIN_KEY, LockNotGranted, Outcome, Space, exclusive_run_ctx
+from ..db import get_session
+from ..utils.progress import ProgressCallbackBase
+
+Shard = namedtuple('Shard', ['index', 'start', 'stop'])
+ShardReport = namedtuple('ShardReport', ['completed', 'skipped', 'busy', 'failed'])
+
+_COMPLETED_SQL = text('''
+SELECT DISTINCT comment FROM activity.job
+WHERE oid = :oid AND comment = ANY(:comments) AND outcome = :outcome
+''')
+
+
+def split_range(start: int, stop: int, shards: int) -> List[Shard]:
+    """
+    :param start: first id, inclusive
+    :param stop: last id, exclusive
+    :param shards: number of shards
+    :return: up to `shards` contiguous, equally sized shards covering `[start, stop)`
+    """
+    assert shards > 0, "at least one shard is required"
+    size, rest = divmod(max(0, stop - start), shards)
+    result = []  # type: List[Shard]
+    for index in range(shards):
+        shard_stop = start + size + (1 if index < rest else 0)
+        if shard_stop > start:
+            result.append(Shard(len(result), start, shard_stop))
+        start = shard_stop
+    return result
+
+
+def id_range(session: Session, column: InstrumentedAttribute) -> Tuple[int, int]:
+    """:return: the smallest and one after the largest value of `column`, e.g. `id_range(session, Data.id)`"""
+    lowest, highest = session.query(func.min(column), func.max(column)).one()
+    return (lowest, highest + 1) if lowest is not None else (0, 0)
+
+
+def shard_comment(name: str, shard: Shard) -> str:
+    """:return: the comment identifying the shard in `activity.job`"""
+    return '%s:%d-%d' % (name, shard.start, shard.stop)
+
+
+def shard_key(name: str, shard: Shard) -> int:
+    """:return: the 4 byte advisory lock key of the shard, stable across processes and nodes"""
+    return zlib.crc32(shard_comment(name, shard).encode('utf-8')) + MIN_KEY
+
+
+def _completed(session: Session, oid: Space, comments: List[str]) -> Set[str]:
+    """:return: the comments of the shards that finished successfully"""
+    rows = session.execute(_COMPLETED_SQL, params=dict(oid=oid.value, comments=comments,
+                                                       outcome=Outcome.SUCCESS.value))
+    return set(row[0] for row in rows)
+
+
+def _run_shard(oid: Space, name: str, shard: Shard, job: Callable[[Shard], Any]) -> Tuple[bool, Any]:
+    """:return: whether the shard ran and the result of the job, executed in the worker processes"""
+    with suppress(LockNotGranted), exclusive_run_ctx(oid, key=shard_key(name, shard),
+                                                     comment=shard_comment(name, shard)):
+        return True, job(shard)
+    return False, None
+
+
+def run_sharded(oid: Space,
+                name: str,
+                job: Callable[[Shard], Any],
+                start: int,
+                stop: int,
+                shards: int,
+                max_workers: Optional[int] = None,
+                progress: Optional[ProgressCallbackBase] = None) -> ShardReport:
+    # pylint: disable=too-many-arguments,too-many-locals
+    """
+    Run `job` once per shard of `[start, stop)` in a process pool.
+    :param oid: the space the shards run in
+    :param name: identifies the sharded job, shards of the same name and range are run only once
+    :param job: called with a `Shard` in a worker process, has to be picklable, i.e. a module level function. it
+                opens its own sessions, e.g. via `get_session`
+    :param start: first id, inclusive
+    :param stop: last id, exclusive
+    :param shards: number of shards
+    :param max_workers: number of worker processes, defaults to the number of cores
+    :param progress: called with `done`, `total` and the last finished `shard` after every shard
+    :return: completed shards mapped to the job results, the shards skipped because they finished earlier, those
+             skipped because another process holds their lock and failed shards mapped to their error
+    """
+    all_shards = split_range(start, stop, shards)
+    finished = set()  # type: Set[str]
+    with get_session() as session:
+        finished = _completed(session, oid, [shard_comment(name, shard) for shard in all_shards])
+    skipped = [shard for shard in all_shards if shard_comment(name, shard) in finished]
+    pending = [shard for shard in all_shards if shard_comment(name, shard) not in finished]
+    completed = {}  # type: Dict[Shard, Any]
+    busy = []  # type: List[Shard]
+    failed = {}  # type: Dict[Shard, BaseException]
+    done = len(skipped)
+    if progress is not None:
+        progress(done=done, total=len(all_shards), shard=None)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(_run_shard, oid, name, shard, job), shard) for shard in pending)
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                ran, result = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.exception('shard %d of %s failed', shard.index, name)
+                failed[shard] = err
+            else:
+                if ran:
+                    completed[shard] = result
+                else:
+                    busy.append(shard)
+            done += 1
+            if progress is not None:
+                progress(done=done, total=len(all_shards), shard=shard)
+    return ShardReport(completed, skipped, busy, failed)
@@ -1,10 +1,16 @@
 """Utilities to run buffered operations"""
 
+import queue
+import sys
+import threading
+import time
 from abc import abstractmethod
-from typing import Callable, Generic, Iterable, List, TypeVar, Union
+from typing import Callable, Generic, Iterable, List, Optional, TypeVar, Union
 
 ET = TypeVar('ET')
 
+_DONE = object()
+
 
 class HandlerBase(Generic[ET]):
     """Base class for `Buffered` handlers"""
@@ -15,36 +21,151 @@ class HandlerBase(Generic[ET]):
         raise NotImplementedError("Not implemented by subclass")
 
 
+def default_sizer(element: object) -> int:
+    """:return: the length of str and bytes like elements, the shallow object size otherwise"""
+    if isinstance(element, (str, bytes, bytearray, memoryview)):
+        return len(element)
+    return sys.getsizeof(element)
+
+
 class Buffered(Generic[ET]):
-    # pylint: disable=too-few-public-methods
-    """simple buffered execution workflow"""
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+    simple buffered execution workflow. in pipelined mode (`pipeline_depth` > 0) the handler runs in a worker thread,
+    so the iterator fills the next batch while the previous one is handled, e.g. a cursor is read while the last batch
+    is written. at most `pipeline_depth` full batches wait for the handler, beyond that the iterator is paused.
+
+    besides reaching `max_size` elements the buffer is handed to the handler once its first element waited
+    `max_latency` seconds, even while the iterator blocks, once the `sizer` estimates reach `max_bytes` or on `flush`.
+    """
 
     def __init__(self,
                  iterator: Iterable[ET],
                  handler: Union[HandlerBase[ET], Callable[[Iterable[ET]], None]],
-                 max_size: int = 1) -> None:
+                 max_size: int = 1,
+                 pipeline_depth: int = 0,
+                 max_latency: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 sizer: Callable[[ET], int] = default_sizer) -> None:
+        # pylint: disable=too-many-arguments
         """
         create a new buffer for the provided `iterator` and execute `handler` in chunks of `max_size` elements
         :param iterator: the iterator values are drawn from
         :param handler: the handler executed on the buffer. a callable of the form (buffer: List[T]) -> None
         :param max_size: maximum size the buffer can grow to before invoking the handler function. must > 0.
+        :param pipeline_depth: number of batches queued for a handler running in a worker thread, 0 runs the handler
+                               synchronously. handler exceptions stop the iteration and are raised by `__call__`
+        :param max_latency: maximum seconds an element waits in the buffer. the handler is then called from a timer
+                            thread, unless pipelined
+        :param max_bytes: estimated bytes at which the buffer is handled, a batch exceeds it by at most one element
+        :param sizer: estimates the bytes of an element, e.g. `lambda data: len(json.dumps(data.data))`
         """
         assert max_size > 0, "buffer must have at least size 1"
+        assert pipeline_depth >= 0, "pipeline depth must not be negative"
+        assert max_latency is None or max_latency > 0, "max latency must be positive"
+        assert max_bytes is None or max_bytes > 0, "max bytes must be positive"
         self._iterator = iterator
         self._handler = handler
         self._buffer: List[ET] = []
         self._max_size = max_size
+        self._pipeline_depth = pipeline_depth
+        self._max_latency = max_latency
+        self._max_bytes = max_bytes
+        self._sizer = sizer
+        self._bytes = 0
+        self._first: Optional[float] = None
+        self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
+        self._batches: Optional[queue.Queue] = None
+        self._errors: List[BaseException] = []
+
+    def _handle(self) -> None:
+        """pass the buffer on to the handler, or to the worker in pipelined mode. the lock has to be held"""
+        batch, self._buffer, self._bytes, self._first = self._buffer, [], 0, None
+        if not batch:
+            return
+        if self._batches is None:
+            self._handler(batch)
+        else:
+            self._batches.put(batch)
+
+    def flush(self) -> None:
+        """hand the buffered elements to the handler right away, safe to call from any thread"""
+        with self._lock:
+            self._handle()
+
+    def _append(self, element: ET) -> None:
+        with self._lock:
+            if not self._buffer:
+                self._first = time.monotonic()
+                self._condition.notify()
+            self._buffer.append(element)
+            if self._max_bytes is not None:
+                self._bytes += self._sizer(element)
+            if self.__len__() >= self.max_size or (self._max_bytes is not None and self._bytes >= self._max_bytes):
+                self._handle()
+
+    def _work(self, batches: queue.Queue) -> None:
+        """worker thread of the pipelined mode, batches after a failure are dropped"""
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                return
+            if not self._errors:
+                try:
+                    self._handler(batch)
+                except BaseException as err:  # pylint: disable=broad-except
+                    self._errors.append(err)
+
+    def _watch(self, stopped: threading.Event) -> None:
+        """timer thread handling the buffer once its first element is older than `max_latency`"""
+        with self._condition:
+            while not stopped.is_set():
+                if self._first is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._first + self._max_latency - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                try:
+                    self._handle()
+                except BaseException as err:  # pylint: disable=broad-except
+                    self._errors.append(err)
+
+    def _consume(self) -> None:
+        for element in self._iterator:
+            self._append(element)
+            if self._errors:
+                return
+        self.flush()
 
     def __call__(self) -> None:
         """exhaust the iterator and call the handler with chunks of `max_size`"""
-        for element in self._iterator:
-            self._buffer.append(element)
-            if self.__len__() >= self.max_size:
-                self._handler(self._buffer)
-                self._buffer = []
-        if self:
-            self._handler(self._buffer)
-            self._buffer = []
+        self._errors = []
+        threads = []  # type: List[threading.Thread]
+        if self._pipeline_depth:
+            self._batches = queue.Queue(maxsize=self._pipeline_depth)
+            threads.append(threading.Thread(target=self._work, args=(self._batches,), name='buffered-handler',
+                                            daemon=True))
+        stopped = threading.Event()
+        if self._max_latency is not None:
+            threads.append(threading.Thread(target=self._watch, args=(stopped,), name='buffered-timer', daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            self._consume()
+        finally:
+            with self._condition:
+                stopped.set()
+                self._condition.notify()
+            if self._batches is not None:
+                self._batches.put(_DONE)
+            for thread in threads:
+                thread.join()
+            self._batches = None
+        if self._errors:
+            raise self._errors[0]
 
     @property
     def max_size(self) -> int:
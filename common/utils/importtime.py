@@ -0,0 +1,65 @@
+"""
+Import time benchmark, runs `python -X importtime` in a fresh interpreter and reports the slowest modules.
+
+    python -m common.utils.importtime common.db.models --budget 250
+
+exits with status 1 if the cumulative import time of a module exceeds the budget (in milliseconds), e.g. in CI.
+"""
+import argparse
+import re
+import subprocess
+import sys
+from collections import namedtuple
+from typing import List, Optional, Sequence
+
+ImportTime = namedtuple('ImportTime', ['module', 'self_us', 'cumulative_us', 'depth'])
+
+_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)\s*$')
+
+
+def parse_importtime(output: str) -> List[ImportTime]:
+    """:return: the entries of `-X importtime` output, in import order"""
+    entries = []  # type: List[ImportTime]
+    for line in output.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append(ImportTime(module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return entries
+
+
+def measure(module: str, python: str = sys.executable) -> List[ImportTime]:
+    """
+    :param module: the module to import
+    :param python: the interpreter to measure with
+    :return: the import times of `module` and all modules it imports, measured in a fresh interpreter
+    """
+    completed = subprocess.run([python, '-X', 'importtime', '-c', 'import %s' % module],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return parse_importtime(completed.stderr)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """:return: the exit status, 1 if a module exceeds the budget"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='+', help='modules to import, each in a fresh interpreter')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest modules to list')
+    parser.add_argument('--budget', type=float, default=None, help='maximum cumulative import time in ms')
+    args = parser.parse_args(argv)
+
+    status = 0
+    for module in args.modules:
+        entries = measure(module)
+        total = next((entry.cumulative_us for entry in reversed(entries) if entry.module == module), 0) / 1000
+        print('%s: %.1fms' % (module, total))
+        for entry in sorted(entries, key=lambda entry: entry.self_us, reverse=True)[:args.top]:
+            print('  %8.1fms self %8.1fms cumulative  %s' % (entry.self_us / 1000, entry.cumulative_us / 1000,
+                                                            entry.module))
+        if args.budget is not None and total > args.budget:
+            print('%s exceeds the budget of %.1fms' % (module, args.budget))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
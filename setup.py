@@ -15,4 +15,10 @@ setup(
         'sqlalchemy',
         'psycopg2'
     ],
+    extras_require={
+        'async': [
+            'sqlalchemy>=1.4',
+            'asyncpg'
+        ],
+    },
 )